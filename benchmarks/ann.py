@@ -0,0 +1,103 @@
+"""Recall and latency of approximate search of similar tracks by item factors.
+
+For each number of scored clusters (`nprobe`), similar tracks of sampled tracks
+are found with the IVF index and compared with exact search. Recall@k and
+per-call latencies (in microseconds) are reported as JSON, to choose
+`ANN_NPROBE` for the required recall.
+
+Usage examples:
+
+`python -m benchmarks.ann --items=1000000 --nprobe=4,16,32,64`
+
+`python -m benchmarks.ann --factors-path=data/item_factors.npy \
+--encoder-path=encoders/item_encoder.pkl`
+"""
+import argparse
+import json
+
+import numpy as np
+
+from service.ann import ItemNeighbours, recall
+
+from .stores import time_calls, timed_load
+
+
+def synthetic_factors(n_items: int, n_factors: int, n_clusters: int, rng):
+    """Generates item factors scattered around random cluster centres."""
+    centres = rng.normal(size=(n_clusters, n_factors)).astype(np.float32)
+    noise = rng.normal(scale=0.5, size=(n_items, n_factors)).astype(np.float32)
+
+    return centres[rng.integers(0, n_clusters, n_items)] + noise
+
+
+def load_factors(args, rng):
+    """Loads item factors of the notebook (or generates synthetic ones)."""
+    if args.factors_path:
+        import joblib
+
+        track_ids = joblib.load(args.encoder_path).classes_
+        return track_ids, np.load(args.factors_path)
+
+    factors = synthetic_factors(args.items, args.factors, args.clusters, rng)
+    return np.arange(args.items), factors
+
+
+def bench_nprobe(neighbours, track_ids: list, k: int, nprobe: int):
+    """Measures recall@k and latency of search scoring nprobe clusters."""
+    return {
+        "recall": recall(neighbours, track_ids, k, nprobe),
+        "search": time_calls(
+            neighbours.search, [([track_id], k, nprobe) for track_id in track_ids]
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--factors-path", help="Item factors (synthetic if not set)")
+    parser.add_argument(
+        "--encoder-path",
+        default="encoders/item_encoder.pkl",
+        help="Item encoder of the factors",
+    )
+    parser.add_argument(
+        "--items", type=int, default=1000000, help="Number of synthetic items"
+    )
+    parser.add_argument(
+        "--factors", type=int, default=50, help="Number of synthetic factors"
+    )
+    parser.add_argument(
+        "--clusters", type=int, default=10000, help="Clusters of synthetic factors"
+    )
+    parser.add_argument(
+        "--nprobe", default="1,4,16,32,64", help="Comma-separated numbers of clusters"
+    )
+    parser.add_argument("--calls", type=int, default=1000, help="Searched tracks")
+    parser.add_argument("--k", type=int, default=10, help="Number of similar tracks")
+    parser.add_argument("--output", help="File to write the report to (JSON)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    track_ids, factors = load_factors(args, rng)
+    neighbours, duration = timed_load(lambda: ItemNeighbours(track_ids, factors))
+    sample = rng.choice(track_ids, args.calls).tolist()
+
+    report = {
+        "config": vars(args),
+        "items": len(neighbours),
+        "build_seconds": duration,
+        "memory_bytes": neighbours.nbytes,
+        "exact": time_calls(
+            neighbours.search, [([track_id], args.k, None, True) for track_id in sample]
+        ),
+        "nprobe": {
+            nprobe: bench_nprobe(neighbours, sample, args.k, int(nprobe))
+            for nprobe in args.nprobe.split(",")
+        },
+    }
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    print(text)
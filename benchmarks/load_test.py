@@ -0,0 +1,332 @@
+"""Load test of the recommendations service reporting latency percentiles.
+
+Requests to `/recommendations`, `/recommendations_online`,
+`/recommendations_offline` (main application) and `/put` (events store) are
+sent by concurrent async clients for a given time after a warmup. RPS and
+latency percentiles of each endpoint are reported as JSON, and the test fails
+(exit code 1) if latencies or the error rate exceed the set thresholds.
+
+Usage example (launching all services on synthetic data):
+
+`python -m benchmarks.load_test --launch --users=100000 --max-latency=p99=50`
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import httpx
+import numpy as np
+
+from service.constants import (
+    BASE_URL,
+    MAIN_APP_PORT,
+    RECS_OFFLINE_SERVICE_PORT,
+    EVENTS_SERVICE_PORT,
+    FEATURES_SERVICE_PORT,
+    PERSONAL_RECS_PATH,
+)
+
+from .synthetic import generate
+
+# Endpoints under load (name => port and path)
+ENDPOINTS = {
+    "recommendations": (MAIN_APP_PORT, "/recommendations"),
+    "recommendations_online": (MAIN_APP_PORT, "/recommendations_online"),
+    "recommendations_offline": (MAIN_APP_PORT, "/recommendations_offline"),
+    "put": (EVENTS_SERVICE_PORT, "/put"),
+}
+DEFAULT_MIX = (
+    "recommendations=0.4,recommendations_online=0.2,"
+    "recommendations_offline=0.3,put=0.1"
+)
+# Reported latency percentiles
+PERCENTILES = {"p50": 50, "p95": 95, "p99": 99, "p999": 99.9}
+# Services launched for the test (with their ports) and the script launching them
+SERVICES = {
+    "recs_store": RECS_OFFLINE_SERVICE_PORT,
+    "features_store": FEATURES_SERVICE_PORT,
+    "events_store": EVENTS_SERVICE_PORT,
+    "main_app": MAIN_APP_PORT,
+}
+RUN_SERVICE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "run_service.py")
+# Number of identifiers (and endpoints) sampled in advance
+SAMPLES = 100000
+
+
+def parse_mix(mix: str):
+    """Parses a request mix `name=weight,...` into shares of endpoints."""
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}', use one of {list(ENDPOINTS)}")
+        weights[name] = float(weight)
+    total = sum(weights.values())
+
+    return {name: weight / total for name, weight in weights.items() if weight > 0}
+
+
+def parse_threshold(threshold: str):
+    """Parses a latency threshold `[endpoint:]percentile=milliseconds`."""
+    name, limit = threshold.split("=")
+    endpoint, _, percentile = name.rpartition(":")
+    if percentile not in PERCENTILES or (endpoint and endpoint not in ENDPOINTS):
+        raise ValueError(f"Invalid latency threshold '{threshold}'")
+
+    return endpoint or None, percentile, float(limit)
+
+
+def sample_ids(n: int, distribution: str, rng, size: int = SAMPLES):
+    """Samples identifiers from 0 to n - 1 uniformly or by Zipf's law (`zipf:a`)."""
+    if distribution == "uniform":
+        return rng.integers(0, n, size).tolist()
+    kind, _, exponent = distribution.partition(":")
+    if kind != "zipf":
+        raise ValueError(f"Unknown distribution '{distribution}'")
+
+    # Assigning Zipf's law weights to identifiers in a random order
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -float(exponent or 1.1)
+    cdf = np.cumsum(weights)
+    ranks = np.searchsorted(cdf, rng.random(size) * cdf[-1])
+
+    return rng.permutation(n)[np.minimum(ranks, n - 1)].tolist()
+
+
+def cycle(samples: list):
+    """Yields samples endlessly."""
+    while True:
+        yield from samples
+
+
+@contextmanager
+def launch_services(workdir: str, workers: int):
+    """Launches all services with data of a directory until exiting the context."""
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    processes = []
+    try:
+        for service in SERVICES:
+            log = open(os.path.join(workdir, "logs", service + ".log"), "w")
+            processes.append(
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        RUN_SERVICE,
+                        f"--service-name={service}",
+                        f"--workers={workers}",
+                    ],
+                    cwd=workdir,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+            )
+            log.close()
+        wait_until_healthy()
+        yield
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def wait_until_healthy(timeout: float = 120):
+    """Waits until all services respond to health checks."""
+    deadline = time.monotonic() + timeout
+    for port in SERVICES.values():
+        while True:
+            try:
+                httpx.get(f"{BASE_URL}:{port}/healthy").raise_for_status()
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Service on port {port} is not healthy")
+                time.sleep(0.5)
+
+
+async def send(client: httpx.AsyncClient, name: str, user_ids, track_ids, k: int):
+    """Sends a request to an endpoint and tells if it succeeded."""
+    port, path = ENDPOINTS[name]
+    params = {"user_id": next(user_ids)}
+    if name == "put":
+        params["track_id"] = next(track_ids)
+    else:
+        params["k"] = k
+    try:
+        response = await client.post(f"{BASE_URL}:{port}{path}", params=params)
+    except httpx.HTTPError:
+        return False
+
+    return response.status_code < 400
+
+
+async def run(args, mix: dict):
+    """Sends requests for warmup and test time and returns their latencies."""
+    rng = np.random.default_rng(args.seed)
+    endpoints = cycle(rng.choice(list(mix), SAMPLES, p=list(mix.values())).tolist())
+    user_ids = cycle(sample_ids(args.users, args.user_dist, rng))
+    track_ids = cycle(sample_ids(args.tracks or 2 * args.users, args.track_dist, rng))
+    latencies = {name: [] for name in mix}
+    errors = {name: 0 for name in mix}
+
+    async def client_loop(client, measure_from: float, end: float):
+        while (start := time.perf_counter()) < end:
+            name = next(endpoints)
+            succeeded = await send(client, name, user_ids, track_ids, args.k)
+            if start < measure_from:
+                continue
+            if succeeded:
+                latencies[name].append(time.perf_counter() - start)
+            else:
+                errors[name] += 1
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        measure_from = time.perf_counter() + args.warmup
+        end = measure_from + args.duration
+        await asyncio.gather(
+            *(client_loop(client, measure_from, end) for _ in range(args.concurrency))
+        )
+
+    return latencies, errors
+
+
+def summarize(latencies: list, errors: int, duration: float):
+    """Returns RPS, error rate and latency percentiles (in milliseconds)."""
+    requests = len(latencies) + errors
+    summary = {
+        "requests": requests,
+        "errors": errors,
+        "error_rate": errors / requests if requests else 0.0,
+        "rps": requests / duration,
+    }
+    latencies = np.array(latencies) * 1000
+    for name, percentile in PERCENTILES.items():
+        value = np.percentile(latencies, percentile) if len(latencies) else None
+        summary[name + "_ms"] = None if value is None else float(value)
+
+    return summary
+
+
+def check_thresholds(report: dict, thresholds: list, max_error_rate: float):
+    """Checks latencies and the error rate against thresholds."""
+    checks = []
+    for endpoint, percentile, limit in thresholds:
+        for name in [endpoint] if endpoint else report["endpoints"]:
+            value = report["endpoints"].get(name, {}).get(percentile + "_ms")
+            checks.append(
+                {
+                    "endpoint": name,
+                    "metric": percentile + "_ms",
+                    "limit": limit,
+                    "value": value,
+                    "passed": value is not None and value <= limit,
+                }
+            )
+    if max_error_rate is not None:
+        value = report["total"]["error_rate"]
+        checks.append(
+            {
+                "endpoint": None,
+                "metric": "error_rate",
+                "limit": max_error_rate,
+                "value": value,
+                "passed": value <= max_error_rate,
+            }
+        )
+
+    return checks
+
+
+def main(args):
+    """Runs a load test and returns its report."""
+    mix = parse_mix(args.mix)
+    thresholds = [parse_threshold(threshold) for threshold in args.max_latency]
+
+    if args.launch:
+        # Generating synthetic data (unless already present) to serve it
+        workdir = args.workdir or tempfile.mkdtemp(prefix="recsys_load_test_")
+        data_dir = os.path.join(workdir, os.path.dirname(PERSONAL_RECS_PATH))
+        if not os.path.exists(os.path.join(workdir, PERSONAL_RECS_PATH)):
+            generate(data_dir, args.users, args.tracks, seed=args.seed)
+        with launch_services(workdir, args.workers):
+            latencies, errors = asyncio.run(run(args, mix))
+    else:
+        latencies, errors = asyncio.run(run(args, mix))
+
+    report = {
+        "config": vars(args),
+        "endpoints": {
+            name: summarize(latencies[name], errors[name], args.duration)
+            for name in mix
+        },
+        "total": summarize(
+            sum(latencies.values(), []), sum(errors.values()), args.duration
+        ),
+    }
+    report["thresholds"] = check_thresholds(report, thresholds, args.max_error_rate)
+    report["passed"] = all(check["passed"] for check in report["thresholds"])
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--launch",
+        action="store_true",
+        help="Launch all services on synthetic data (otherwise use running ones)",
+    )
+    parser.add_argument(
+        "--workdir", help="Directory of synthetic data and logs of launched services"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Workers of each launched service"
+    )
+    parser.add_argument(
+        "--users", type=int, default=100000, help="Number of users (ids 0..users-1)"
+    )
+    parser.add_argument(
+        "--tracks", type=int, default=None, help="Number of tracks (2 per user)"
+    )
+    parser.add_argument("--concurrency", type=int, default=32, help="Async clients")
+    parser.add_argument(
+        "--duration", type=float, default=30, help="Test time (seconds)"
+    )
+    parser.add_argument("--warmup", type=float, default=5, help="Warmup time (seconds)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Shares of endpoints")
+    parser.add_argument(
+        "--user-dist", default="zipf:1.1", help="'uniform' or 'zipf:<exponent>'"
+    )
+    parser.add_argument(
+        "--track-dist", default="zipf:1.1", help="'uniform' or 'zipf:<exponent>'"
+    )
+    parser.add_argument("--k", type=int, default=10, help="Number of recs requested")
+    parser.add_argument(
+        "--timeout", type=float, default=10, help="Request timeout (seconds)"
+    )
+    parser.add_argument(
+        "--max-latency",
+        action="append",
+        default=[],
+        help="Latency threshold '[endpoint:]p99=<milliseconds>' (repeatable)",
+    )
+    parser.add_argument(
+        "--max-error-rate", type=float, default=None, help="Error rate threshold"
+    )
+    parser.add_argument("--output", help="File to write the report to (JSON)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    report = main(args)
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    print(text)
+    sys.exit(0 if report["passed"] else 1)
@@ -0,0 +1,216 @@
+"""Microbenchmarks of the stores on synthetic data of several scales.
+
+For each number of users, synthetic data files are generated (unless already
+present), loaded by the store classes, and the hot functions are called with
+sampled identifiers. Load time, memory and per-call latencies (in
+microseconds) are reported as JSON.
+
+Usage example:
+
+`python -m benchmarks.stores --users=10000,100000,1000000 --output=stores.json`
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from service.events_service import EventStore
+from service.features_service import SimilarTracks
+from service.merge import AGGREGATIONS, aggregate, blend, top_k
+from service.recs_offline_service import Recommender
+
+from .load_test import sample_ids
+from .synthetic import generate
+
+# Reported latency percentiles
+PERCENTILES = {"p50": 50, "p99": 99}
+
+
+def time_calls(function, calls: list):
+    """Calls a function with each of argument tuples and summarizes latencies."""
+    latencies = np.empty(len(calls))
+    for i, call_args in enumerate(calls):
+        start = time.perf_counter_ns()
+        function(*call_args)
+        latencies[i] = time.perf_counter_ns() - start
+    latencies /= 1000
+    summary = {"calls": len(calls), "mean_us": float(latencies.mean())}
+    for name, percentile in PERCENTILES.items():
+        summary[name + "_us"] = float(np.percentile(latencies, percentile))
+
+    return summary
+
+
+def timed_load(load):
+    """Calls a loading function and returns its result and duration."""
+    start = time.perf_counter()
+    result = load()
+
+    return result, time.perf_counter() - start
+
+
+def bench_recs_store(paths: dict, user_ids: list, k: int, batch_size: int):
+    """Benchmarks loading and retrieving offline recommendations."""
+    rec_store = Recommender()
+    _, duration = timed_load(
+        lambda: (
+            rec_store.load(rec_type="personal", path=paths["personal"]),
+            rec_store.load(rec_type="default", path=paths["default"]),
+        )
+    )
+    batches = [
+        user_ids[i : i + batch_size] for i in range(0, len(user_ids), batch_size)
+    ]
+
+    return {
+        "load_seconds": duration,
+        "peak_bytes": max(m["peak_bytes"] for m in rec_store.load_memory.values()),
+        "memory_bytes": sum(m["steady_bytes"] for m in rec_store.load_memory.values()),
+        "get": time_calls(rec_store.get, [(user_id, k) for user_id in user_ids]),
+        "get_batch": time_calls(rec_store.get_batch, [(b, k) for b in batches]),
+    }
+
+
+def bench_features_store(path: str, track_ids: list, k: int, num_events: int):
+    """Benchmarks loading and retrieving similar tracks."""
+    sim_items_store = SimilarTracks()
+    _, duration = timed_load(lambda: sim_items_store.load(path=path))
+    events = [
+        track_ids[i : i + num_events] for i in range(0, len(track_ids), num_events)
+    ]
+
+    return {
+        "load_seconds": duration,
+        "peak_bytes": sim_items_store.load_memory["similar"]["peak_bytes"],
+        "memory_bytes": sim_items_store.load_memory["similar"]["steady_bytes"],
+        "get": time_calls(sim_items_store.get, [(t, k) for t in track_ids]),
+        "get_batch_merged": time_calls(
+            sim_items_store.get_batch, [(e, k, True) for e in events]
+        ),
+    }
+
+
+def bench_events_store(user_ids: list, track_ids: list, num_events: int):
+    """Benchmarks adding and retrieving online history."""
+    event_store = EventStore()
+    calls = list(zip(user_ids, track_ids))
+    put = time_calls(event_store.put, calls)
+    get = time_calls(event_store.get, [(user_id, num_events) for user_id in user_ids])
+
+    # Measuring memory of the same events added to a new store
+    tracemalloc.start()
+    event_store = EventStore()
+    for user_id, track_id in calls:
+        event_store.put(user_id, track_id)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "resident_users": len(event_store.events),
+        "memory_bytes": memory,
+        "put": put,
+        "get": get,
+    }
+
+
+def bench_merging(rng, n_tracks: int, k: int, num_events: int, calls: int):
+    """Benchmarks aggregation, top-k selection and blending of candidate lists."""
+    candidates = rng.integers(0, n_tracks, (calls, num_events * k))
+    scores = rng.random((calls, num_events * k))
+    sources = np.repeat(np.arange(num_events), k)
+    lists = rng.integers(0, n_tracks, (calls, 2, k)).tolist()
+
+    report = {
+        "aggregate_"
+        + how: time_calls(
+            aggregate, [(c, s, how, sources) for c, s in zip(candidates, scores)]
+        )
+        for how in AGGREGATIONS
+    }
+    report["top_k"] = time_calls(top_k, [(s, k) for s in scores])
+    report["blend"] = time_calls(blend, [(pair, [1.0, 1.0], k) for pair in lists])
+
+    return report
+
+
+def generate_once(data_dir: str, n_users: int, seed: int):
+    """Generates synthetic data unless it has been generated before."""
+    summary_path = os.path.join(data_dir, "summary.json")
+    if os.path.exists(summary_path):
+        with open(summary_path) as file:
+            return json.load(file)
+
+    summary = generate(data_dir, n_users, seed=seed)
+    with open(summary_path, "w") as file:
+        json.dump(summary, file)
+
+    return summary
+
+
+def bench_scale(args, n_users: int):
+    """Generates (or reuses) data of a number of users and benchmarks the stores."""
+    data_dir = os.path.join(args.workdir, f"users_{n_users}_seed_{args.seed}")
+    summary = generate_once(data_dir, n_users, args.seed)
+    rng = np.random.default_rng(args.seed)
+    user_ids = sample_ids(n_users, args.user_dist, rng, args.calls)
+    track_ids = sample_ids(summary["tracks"], args.track_dist, rng, args.calls)
+
+    return {
+        "data": {key: value for key, value in summary.items() if key != "paths"},
+        "recs_store": bench_recs_store(
+            summary["paths"], user_ids, args.k, args.batch_size
+        ),
+        "features_store": bench_features_store(
+            summary["paths"]["similar"], track_ids, args.k, args.num_events
+        ),
+        "events_store": bench_events_store(user_ids, track_ids, args.num_events),
+        "merge": bench_merging(
+            rng, summary["tracks"], args.k, args.num_events, args.calls
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--users", default="10000,100000", help="Comma-separated numbers of users"
+    )
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "recsys_benchmarks"),
+        help="Directory of synthetic data",
+    )
+    parser.add_argument("--calls", type=int, default=10000, help="Calls per function")
+    parser.add_argument("--k", type=int, default=10, help="Number of recs requested")
+    parser.add_argument(
+        "--num-events", type=int, default=3, help="Events per online recs request"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="Users per get_batch call"
+    )
+    parser.add_argument(
+        "--user-dist", default="zipf:1.1", help="'uniform' or 'zipf:<exponent>'"
+    )
+    parser.add_argument(
+        "--track-dist", default="zipf:1.1", help="'uniform' or 'zipf:<exponent>'"
+    )
+    parser.add_argument("--output", help="File to write the report to (JSON)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    report = {
+        "config": vars(args),
+        "scales": {
+            n_users: bench_scale(args, int(n_users))
+            for n_users in args.users.split(",")
+        },
+    }
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    print(text)
@@ -0,0 +1,134 @@
+"""Generates synthetic data files of the stores at a configurable scale.
+
+Usage example:
+
+`python -m benchmarks.synthetic --users=100000 --data-dir=/tmp/recsys/data`
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from service.constants import PERSONAL_RECS_PATH, DEFAULT_RECS_PATH, ONLINE_RECS_PATH
+
+# Number of users (or tracks) generated and written at once
+CHUNK_SIZE = 1000000
+
+
+def sorted_desc(scores):
+    """Sorts scores of each row (one row per user or track) in descending order."""
+    return -np.sort(-scores, axis=1)
+
+
+def write_personal_recs(path, rng, users, n_tracks: int, recs_per_user: int):
+    """Writes ranked personal recommendations of users (sorted by user)."""
+    schema = pa.schema(
+        [("user_id", pa.int64()), ("track_id", pa.int64()), ("score", pa.float32())]
+    )
+    with pq.ParquetWriter(path, schema) as writer:
+        for start in range(0, len(users), CHUNK_SIZE):
+            chunk = users[start : start + CHUNK_SIZE]
+            shape = (len(chunk), recs_per_user)
+            scores = sorted_desc(rng.random(shape, dtype=np.float32))
+            table = pa.table(
+                {
+                    "user_id": np.repeat(chunk, recs_per_user),
+                    "track_id": rng.integers(0, n_tracks, shape).ravel(),
+                    "score": scores.ravel(),
+                },
+                schema=schema,
+            )
+            writer.write_table(table)
+
+
+def write_similar_tracks(path, rng, tracks, n_tracks: int, similar_per_track: int):
+    """Writes similar tracks of tracks sorted by similarity score."""
+    schema = pa.schema(
+        [
+            ("track_id_1", pa.int64()),
+            ("track_id_2", pa.int64()),
+            ("score", pa.float64()),
+        ]
+    )
+    with pq.ParquetWriter(path, schema) as writer:
+        for start in range(0, len(tracks), CHUNK_SIZE):
+            chunk = tracks[start : start + CHUNK_SIZE]
+            shape = (len(chunk), similar_per_track)
+            table = pa.table(
+                {
+                    "track_id_1": np.repeat(chunk, similar_per_track),
+                    "track_id_2": rng.integers(0, n_tracks, shape).ravel(),
+                    "score": sorted_desc(rng.random(shape)).ravel(),
+                },
+                schema=schema,
+            )
+            writer.write_table(table)
+
+
+def generate(
+    data_dir: str,
+    n_users: int,
+    n_tracks: int = None,
+    recs_per_user: int = 10,
+    similar_per_track: int = 10,
+    personal_share: float = 0.7,
+    similar_share: float = 0.3,
+    n_popular: int = 100,
+    seed: int = 0,
+):
+    """Writes personal recs, top-popular tracks and similar tracks to a directory.
+
+    Users are numbered from 0 to n_users - 1 and tracks from 0 to n_tracks - 1,
+    with a share of them having personal recs (or similar tracks). Returns a
+    summary of the generated data.
+    """
+    rng = np.random.default_rng(seed)
+    n_tracks = n_tracks or 2 * n_users
+    os.makedirs(data_dir, exist_ok=True)
+    paths = {
+        "personal": os.path.join(data_dir, os.path.basename(PERSONAL_RECS_PATH)),
+        "default": os.path.join(data_dir, os.path.basename(DEFAULT_RECS_PATH)),
+        "similar": os.path.join(data_dir, os.path.basename(ONLINE_RECS_PATH)),
+    }
+
+    # Choosing users with personal recs and tracks with similar tracks
+    users = np.flatnonzero(rng.random(n_users) < personal_share)
+    tracks = np.flatnonzero(rng.random(n_tracks) < similar_share)
+    write_personal_recs(paths["personal"], rng, users, n_tracks, recs_per_user)
+    write_similar_tracks(paths["similar"], rng, tracks, n_tracks, similar_per_track)
+
+    # Top-popular tracks ordered by the number of plays
+    popular = rng.choice(n_tracks, min(n_popular, n_tracks), replace=False)
+    plays = np.sort(rng.integers(1, 10 * n_users, len(popular)))[::-1]
+    pq.write_table(
+        pa.table({"track_id": popular, "tracks_played": plays}), paths["default"]
+    )
+
+    return {
+        "users": n_users,
+        "personal_users": len(users),
+        "tracks": n_tracks,
+        "similar_tracks": len(tracks),
+        "paths": paths,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100000, help="Number of users")
+    parser.add_argument(
+        "--tracks", type=int, default=None, help="Number of tracks (2 per user)"
+    )
+    parser.add_argument(
+        "--data-dir", required=True, help="Directory to write the files to"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    start = time.time()
+    summary = generate(args.data_dir, args.users, args.tracks, seed=args.seed)
+    print(summary)
+    print(f"Generation took {time.time() - start:.2f} seconds")
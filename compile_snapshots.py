@@ -0,0 +1,75 @@
+"""Compiles parquet files of the stores into memory-mapped snapshots.
+
+Usage example:
+
+`python compile_snapshots.py --store=all`
+
+Personal recommendations can also be partitioned for the lazy mode of the recs
+store (`--store=recs_store_lazy`).
+"""
+import argparse
+import time
+
+from service.constants import (
+    PERSONAL_RECS_PATH,
+    DEFAULT_RECS_PATH,
+    ONLINE_RECS_PATH,
+    RECS_SNAPSHOT_PATH,
+    ONLINE_RECS_SNAPSHOT_PATH,
+    LAZY_RECS_PATH,
+    LAZY_RECS_ROW_GROUP_SIZE,
+)
+from service.features_service import SimilarTracks
+from service.lazy import write_lazy_recs
+from service.recs_offline_service import Recommender
+
+# Enumerating stores to compile
+OPTION_RECS = "recs_store"
+OPTION_FEATURES = "features_store"
+OPTION_ALL = "all"
+OPTION_RECS_LAZY = "recs_store_lazy"
+OPTIONS = (OPTION_RECS, OPTION_FEATURES, OPTION_ALL, OPTION_RECS_LAZY)
+
+# Help message for options
+HELP_MSG = f"Available options: {list(OPTIONS)}"
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-s",
+    "--store",
+    default=OPTION_ALL,
+    help="Store to compile. " + HELP_MSG,
+)
+args = parser.parse_args()
+
+
+def compile_recs_store():
+    """Compiles personal and default recommendations into one snapshot."""
+    rec_store = Recommender()
+    rec_store.load(rec_type="personal", path=PERSONAL_RECS_PATH)
+    rec_store.load(rec_type="default", path=DEFAULT_RECS_PATH)
+    rec_store.save_snapshot(RECS_SNAPSHOT_PATH)
+
+
+def compile_features_store():
+    """Compiles track similarities into a snapshot."""
+    sim_items_store = SimilarTracks()
+    sim_items_store.load(path=ONLINE_RECS_PATH)
+    sim_items_store.save_snapshot(ONLINE_RECS_SNAPSHOT_PATH)
+
+
+if __name__ == "__main__":
+    start = time.time()
+    if args.store in (OPTION_RECS, OPTION_ALL):
+        compile_recs_store()
+        print(f"Snapshot '{RECS_SNAPSHOT_PATH}' has been compiled")
+    if args.store in (OPTION_FEATURES, OPTION_ALL):
+        compile_features_store()
+        print(f"Snapshot '{ONLINE_RECS_SNAPSHOT_PATH}' has been compiled")
+    if args.store == OPTION_RECS_LAZY:
+        write_lazy_recs(PERSONAL_RECS_PATH, LAZY_RECS_PATH, LAZY_RECS_ROW_GROUP_SIZE)
+        print(f"Partitioned recommendations '{LAZY_RECS_PATH}' have been written")
+    if args.store not in OPTIONS:
+        print(f"Store '{args.store}' is invalid" + f"\n{HELP_MSG}")
+    else:
+        print(f"Compilation took {time.time() - start:.2f} seconds")
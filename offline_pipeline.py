@@ -0,0 +1,247 @@
+"""Generates offline recommendations and similar tracks from ALS factors.
+
+Users (or tracks) are split into chunks of fixed size which are scored against
+all tracks by workers of a process pool, and each chunk is written to parquet
+as soon as it is done, so that memory does not depend on the number of users.
+Factors are mapped into memory and shared by the workers.
+
+Usage example:
+
+`python offline_pipeline.py --output=all --k=10 --similar-k=5 --workers=4`
+
+Identifiers of users and tracks are taken from the encoders of the notebook
+(or from .npy files of identifiers ordered as rows of the factors).
+
+Personal recommendations are ordered by ALS scores only (not ranked by the
+model of the notebook), so they are written next to the served ones by default.
+Each file is written under a temporary name and moved into place when complete.
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from service.ann import exact_search, normalize
+from service.constants import (
+    PIPELINE_RECS_PATH,
+    ONLINE_RECS_PATH,
+    USER_FACTORS_PATH,
+    USER_ENCODER_PATH,
+    ITEM_FACTORS_PATH,
+    ITEM_ENCODER_PATH,
+    PIPELINE_CHUNK_SIZE,
+    PIPELINE_BLOCK_SIZE,
+)
+
+# Enumerating outputs of the pipeline
+OPTION_RECS = "recs"
+OPTION_SIMILAR = "similar"
+OPTION_ALL = "all"
+OPTIONS = (OPTION_RECS, OPTION_SIMILAR, OPTION_ALL)
+
+# Schemas of the written files
+RECS_SCHEMA = pa.schema(
+    [("user_id", pa.int64()), ("track_id", pa.int64()), ("als_score", pa.float32())]
+)
+SIMILAR_SCHEMA = pa.schema(
+    [("track_id_1", pa.int64()), ("track_id_2", pa.int64()), ("score", pa.float32())]
+)
+
+# Data of a worker process (set by its initializer)
+worker = {}
+
+
+def load_ids(path: str):
+    """Loads identifiers ordered as rows of factors (from an encoder or .npy)."""
+    if path.endswith(".npy"):
+        return np.load(path)
+    # Unpickling encoders needs scikit-learn
+    import joblib
+
+    return joblib.load(path).classes_
+
+
+def init_worker(paths: dict, block_size: int):
+    """Maps factors and loads identifiers of users and tracks in a worker."""
+    for name, path in paths.items():
+        if name.endswith("factors"):
+            worker[name] = np.load(path, mmap_mode="r")
+        else:
+            worker[name] = load_ids(path)
+    worker["block_size"] = block_size
+
+
+def recommend_chunk(start: int, end: int, k: int):
+    """Finds k tracks with the highest ALS scores for users of a chunk."""
+    queries = np.asarray(worker["user_factors"][start:end], dtype=np.float32)
+    rows, scores = exact_search(
+        queries, worker["item_factors"], k, worker["block_size"]
+    )
+
+    return {
+        "user_id": np.repeat(worker["user_ids"][start:end], rows.shape[1]),
+        "track_id": worker["track_ids"][rows.ravel()],
+        "als_score": scores.ravel(),
+    }
+
+
+def similar_chunk(start: int, end: int, k: int):
+    """Finds k most similar tracks (by cosine) for tracks of a chunk."""
+    vectors = worker["normalized_factors"]
+    rows, scores = exact_search(
+        vectors[start:end], vectors, k + 1, worker["block_size"]
+    )
+    # Dropping each track itself (or its last neighbour if it was not found)
+    keep = rows != np.arange(start, end)[:, None]
+    keep[keep.all(axis=1), -1] = False
+    n_similar = rows.shape[1] - 1
+
+    return {
+        "track_id_1": np.repeat(worker["track_ids"][start:end], n_similar),
+        "track_id_2": worker["track_ids"][rows[keep]],
+        "score": scores[keep],
+    }
+
+
+def run_chunks(function, n: int, k: int, path: str, schema, args, paths: dict):
+    """Runs a function over chunks of rows on a process pool writing results.
+
+    At most two chunks per worker are pending at once, and results are
+    written in the order of chunks to a temporary file replacing the file at
+    the path once all of them are written.
+    """
+    bounds = [
+        (start, min(start + args.chunk_size, n))
+        for start in range(0, n, args.chunk_size)
+    ]
+    pending = deque()
+    written = 0
+
+    def write_oldest():
+        nonlocal written
+        columns = pending.popleft().result()
+        writer.write_table(pa.table(columns, schema=schema))
+        written += 1
+        print(f"{written}/{len(bounds)} chunks written", end="\r")
+
+    tmp_path = path + ".tmp"
+    try:
+        with (
+            ProcessPoolExecutor(
+                args.workers,
+                initializer=init_worker,
+                initargs=(paths, args.block_size),
+            ) as executor,
+            pq.ParquetWriter(tmp_path, schema) as writer,
+        ):
+            for start, end in bounds:
+                pending.append(executor.submit(function, start, end, k))
+                # Writing the oldest chunk while the others are computed
+                if len(pending) >= 2 * args.workers:
+                    write_oldest()
+            while pending:
+                write_oldest()
+    except BaseException:
+        # Leaving the file at the path intact if the run fails
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # Replacing the file at once (stores never see a partially written file)
+    os.replace(tmp_path, path)
+    print()
+
+
+def write_recs(args):
+    """Writes k personal recommendations of all users."""
+    paths = {
+        "user_factors": args.user_factors,
+        "item_factors": args.item_factors,
+        "user_ids": args.user_encoder,
+        "track_ids": args.item_encoder,
+    }
+    n_users = len(np.load(args.user_factors, mmap_mode="r"))
+    run_chunks(
+        recommend_chunk, n_users, args.k, args.recs_path, RECS_SCHEMA, args, paths
+    )
+
+
+def write_similar(args):
+    """Writes k similar tracks of all tracks."""
+    # Normalizing factors once into a file mapped by all workers
+    factors = np.load(args.item_factors, mmap_mode="r")
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(args.similar_path))
+    ) as tmp:
+        normalized_path = os.path.join(tmp, "normalized_factors.npy")
+        normalized = np.lib.format.open_memmap(
+            normalized_path, mode="w+", dtype=np.float32, shape=factors.shape
+        )
+        for start in range(0, len(factors), args.block_size):
+            block = factors[start : start + args.block_size]
+            normalized[start : start + args.block_size] = normalize(block)
+        normalized.flush()
+        del normalized
+
+        paths = {"normalized_factors": normalized_path, "track_ids": args.item_encoder}
+        run_chunks(
+            similar_chunk,
+            len(factors),
+            args.similar_k,
+            args.similar_path,
+            SIMILAR_SCHEMA,
+            args,
+            paths,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output",
+        default=OPTION_ALL,
+        help=f"Files to generate. Available options: {list(OPTIONS)}",
+    )
+    parser.add_argument("--user-factors", default=USER_FACTORS_PATH)
+    parser.add_argument("--item-factors", default=ITEM_FACTORS_PATH)
+    parser.add_argument("--user-encoder", default=USER_ENCODER_PATH)
+    parser.add_argument("--item-encoder", default=ITEM_ENCODER_PATH)
+    parser.add_argument("--recs-path", default=PIPELINE_RECS_PATH)
+    parser.add_argument("--similar-path", default=ONLINE_RECS_PATH)
+    parser.add_argument("--k", type=int, default=10, help="Recommendations per user")
+    parser.add_argument(
+        "--similar-k", type=int, default=5, help="Similar tracks per track"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=PIPELINE_CHUNK_SIZE,
+        help="Users (or tracks) per chunk",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=PIPELINE_BLOCK_SIZE,
+        help="Tracks scored at once",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Worker processes"
+    )
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.output in (OPTION_RECS, OPTION_ALL):
+        write_recs(args)
+        print(f"Recommendations '{args.recs_path}' have been written")
+    if args.output in (OPTION_SIMILAR, OPTION_ALL):
+        write_similar(args)
+        print(f"Similar tracks '{args.similar_path}' have been written")
+    if args.output not in OPTIONS:
+        print(f"Output '{args.output}' is invalid. Available options: {list(OPTIONS)}")
+    else:
+        print(f"Pipeline took {time.time() - start:.2f} seconds")
@@ -1,5 +1,6 @@
 """Launches a service of a recommendations application."""
 import argparse
+import os
 
 import uvicorn
 
@@ -8,6 +9,8 @@ from service.constants import (
     RECS_OFFLINE_SERVICE_PORT,
     EVENTS_SERVICE_PORT,
     FEATURES_SERVICE_PORT,
+    EVENTS_BACKEND_ENV,
+    SERVICE_MODE_ENV,
 )
 
 # Enumerating services
@@ -21,9 +24,10 @@ OPTION_MAIN = "main_app"
 OPTION_RECS = "recs_store"
 OPTION_EVENTS = "events_store"
 OPTION_FEATURES = "features_store"
+OPTION_ALL = "all"
 
 # Help message for options
-HELP_MSG = f"Available options: ['{OPTION_MAIN}', '{OPTION_RECS}', '{OPTION_EVENTS}', '{OPTION_FEATURES}']"
+HELP_MSG = f"Available options: ['{OPTION_MAIN}', '{OPTION_RECS}', '{OPTION_EVENTS}', '{OPTION_FEATURES}', '{OPTION_ALL}']"
 
 # Adding an argument for launching a specific service
 parser = argparse.ArgumentParser()
@@ -32,6 +36,13 @@ parser.add_argument(
     "--service-name",
     help="Service name to run. " + HELP_MSG,
 )
+parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of worker processes of the service",
+)
 args = parser.parse_args()
 
 if __name__ == "__main__":
@@ -40,24 +51,41 @@ if __name__ == "__main__":
         uvicorn.run(
             app=MAIN_APP,
             port=MAIN_APP_PORT,
+            workers=args.workers,
         )
     # Launching offline recommendations service
     elif args.service_name == OPTION_RECS:
         uvicorn.run(
             app=RECS_APP,
             port=RECS_OFFLINE_SERVICE_PORT,
+            workers=args.workers,
         )
     # Launching service for storing events
     elif args.service_name == OPTION_EVENTS:
+        # Sharing events between workers through an embedded database
+        if args.workers > 1:
+            os.environ.setdefault(EVENTS_BACKEND_ENV, "sqlite")
         uvicorn.run(
             app=EVENTS_APP,
             port=EVENTS_SERVICE_PORT,
+            workers=args.workers,
         )
     # Launching a service for online recommendations
     elif args.service_name == OPTION_FEATURES:
         uvicorn.run(
             app=FEATURES_APP,
             port=FEATURES_SERVICE_PORT,
+            workers=args.workers,
+        )
+    # Launching main application with all stores loaded into its process
+    elif args.service_name == OPTION_ALL:
+        os.environ[SERVICE_MODE_ENV] = "all"
+        if args.workers > 1:
+            os.environ.setdefault(EVENTS_BACKEND_ENV, "sqlite")
+        uvicorn.run(
+            app=MAIN_APP,
+            port=MAIN_APP_PORT,
+            workers=args.workers,
         )
     # Processing 'no arguments' / 'invalid arguments' cases
     else:
@@ -0,0 +1,214 @@
+"""Nearest neighbours of items by cosine similarity of their ALS factors.
+
+Items are searched either exactly (blocked matrix products over the whole
+catalog) or approximately with an inverted file index (IVF): factors are
+clustered by spherical k-means and only the items of the `nprobe` clusters
+closest to a query are scored, `nprobe` trading recall for latency.
+"""
+import numpy as np
+
+from .constants import (
+    ANN_BLOCK_SIZE,
+    ANN_KMEANS_ITERATIONS,
+    ANN_MIN_ITEMS,
+    ANN_NLIST,
+    ANN_NPROBE,
+    ANN_TRAIN_SIZE,
+)
+
+
+def normalize(vectors):
+    """Scales vectors to unit length (so that inner products are cosines)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def select_top(scores, k: int):
+    """Returns columns of the k highest scores of each row in descending order."""
+    if k < scores.shape[1]:
+        columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, columns, axis=1), axis=1)
+
+    return np.take_along_axis(columns, order, axis=1)
+
+
+def exact_search(queries, vectors, k: int, block_size: int = ANN_BLOCK_SIZE):
+    """Finds the k vectors with the highest inner products with each query.
+
+    Vectors are scored block by block, keeping the best k of each query so
+    far, so that memory does not grow with the number of vectors.
+    Returns rows of found vectors and their scores (queries x k).
+    """
+    k = min(k, len(vectors))
+    rows = np.empty((len(queries), 0), dtype=np.int64)
+    scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start : start + block_size]
+        block_rows = np.arange(start, start + len(block))
+        rows = np.hstack(
+            [rows, np.broadcast_to(block_rows, (len(queries), len(block)))]
+        )
+        scores = np.hstack([scores, queries @ block.T])
+        best = select_top(scores, k)
+        rows = np.take_along_axis(rows, best, axis=1)
+        scores = np.take_along_axis(scores, best, axis=1)
+
+    return rows, scores
+
+
+def kmeans(vectors, n_clusters: int, iterations: int, rng):
+    """Clusters unit vectors by spherical k-means and returns unit centroids."""
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(iterations):
+        labels = assign(vectors, centroids)
+        # Summing vectors of each cluster (keeping centroids of empty ones)
+        counts = np.bincount(labels, minlength=n_clusters)
+        starts = np.cumsum(counts) - counts
+        sums = centroids.copy()
+        sums[counts > 0] = np.add.reduceat(
+            vectors[np.argsort(labels)], starts[counts > 0]
+        )
+        centroids = normalize(sums)
+
+    return centroids
+
+
+def assign(vectors, centroids, block_size: int = ANN_BLOCK_SIZE):
+    """Returns the closest centroid of each vector."""
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + block_size] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), block_size)
+        ]
+    )
+
+
+class IVFIndex:
+    """Class for approximate inner product search in an inverted file index."""
+
+    def __init__(
+        self,
+        vectors,
+        nlist: int = ANN_NLIST,
+        iterations: int = ANN_KMEANS_ITERATIONS,
+        train_size: int = ANN_TRAIN_SIZE,
+        seed: int = 0,
+    ) -> None:
+        """Clusters unit vectors and builds inverted lists of the clusters."""
+        rng = np.random.default_rng(seed)
+        nlist = max(1, min(nlist, len(vectors)))
+        sample = vectors
+        if len(vectors) > train_size:
+            sample = vectors[rng.choice(len(vectors), train_size, replace=False)]
+        self.centroids = kmeans(sample, nlist, iterations, rng)
+
+        # Storing vectors of each list contiguously (offsets as in a CSR matrix)
+        labels = assign(vectors, self.centroids)
+        self.rows = np.argsort(labels, kind="stable")
+        self.vectors = np.ascontiguousarray(vectors[self.rows])
+        self.offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=self.offsets[1:])
+
+    @property
+    def nbytes(self):
+        """Returns the memory taken by the index."""
+        return sum(
+            array.nbytes
+            for array in (self.centroids, self.rows, self.vectors, self.offsets)
+        )
+
+    def search(self, queries, k: int, nprobe: int = ANN_NPROBE):
+        """Finds k vectors with approximately the highest inner products.
+
+        Lists of the `nprobe` closest centroids are scored, along with the next
+        closest ones until they hold at least k vectors (so any k is served).
+        Returns rows of found vectors and their scores for each query.
+        """
+        k = min(k, len(self.rows))
+        sizes = np.diff(self.offsets)
+        results = []
+        for query, centroid_scores in zip(queries, queries @ self.centroids.T):
+            lists = np.argsort(-centroid_scores)
+            probed = max(nprobe, np.searchsorted(np.cumsum(sizes[lists]), k) + 1)
+            positions = np.concatenate(
+                [
+                    np.arange(self.offsets[i], self.offsets[i + 1])
+                    for i in lists[:probed]
+                ]
+            )
+            scores = self.vectors[positions] @ query
+            best = select_top(scores[None, :], k)[0]
+            results.append((self.rows[positions[best]], scores[best]))
+
+        return results
+
+
+class ItemNeighbours:
+    """Class for retrieving items similar to given ones by their factors."""
+
+    def __init__(self, item_ids, factors, min_items: int = ANN_MIN_ITEMS) -> None:
+        """Initializes a class instance (factor rows ordered as sorted item_ids)."""
+        self.item_ids = np.asarray(item_ids)
+        self.vectors = normalize(factors)
+        # Searching small catalogs exactly
+        self.index = IVFIndex(self.vectors) if len(self.vectors) >= min_items else None
+
+    def __len__(self):
+        """Returns the number of items."""
+        return len(self.item_ids)
+
+    @property
+    def nbytes(self):
+        """Returns the memory taken by the factors and the index."""
+        index_nbytes = self.index.nbytes if self.index is not None else 0
+
+        return self.item_ids.nbytes + self.vectors.nbytes + index_nbytes
+
+    def locate(self, item_ids):
+        """Returns factor rows of items and whether each item is known."""
+        item_ids = np.asarray(item_ids, dtype=self.item_ids.dtype)
+        rows = np.searchsorted(self.item_ids, item_ids)
+        rows = np.minimum(rows, len(self.item_ids) - 1)
+
+        return rows, self.item_ids[rows] == item_ids
+
+    def search(self, item_ids, k: int, nprobe: int = ANN_NPROBE, exact=False):
+        """Finds k items most similar to each of given ones (excluding themselves).
+
+        Returns a list of arrays of found items and their scores (None for
+        unknown items).
+        """
+        rows, found = self.locate(item_ids)
+        queries = self.vectors[rows[found]]
+        # Searching one more item since the item itself is usually found
+        if self.index is None or exact:
+            results = zip(*exact_search(queries, self.vectors, k + 1))
+        else:
+            results = self.index.search(queries, k + 1, nprobe)
+
+        neighbours = []
+        for row, (found_rows, scores) in zip(rows[found], results):
+            keep = found_rows != row
+            neighbours.append((self.item_ids[found_rows[keep][:k]], scores[keep][:k]))
+        # Placing None for unknown items
+        neighbours = iter(neighbours)
+
+        return [next(neighbours) if is_found else None for is_found in found]
+
+
+def recall(neighbours: ItemNeighbours, item_ids, k: int, nprobe: int = ANN_NPROBE):
+    """Measures the share of exact k nearest neighbours found by the index."""
+    approximate = neighbours.search(item_ids, k, nprobe)
+    exact = neighbours.search(item_ids, k, exact=True)
+    hits = sum(
+        len(np.intersect1d(found[0], true[0]))
+        for found, true in zip(approximate, exact)
+        if true is not None
+    )
+    total = sum(len(true[0]) for true in exact if true is not None)
+
+    return hits / total if total else 1.0
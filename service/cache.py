@@ -0,0 +1,65 @@
+"""In-memory cache of offline recommendations in the main application."""
+import time
+from collections import OrderedDict
+
+
+class RecsCache:
+    """Class for caching offline recommendations by user (LRU with TTL).
+
+    One list is kept per user (not per k), so that requests with smaller k
+    are served by slicing the cached list.
+    """
+
+    def __init__(self, max_users: int, ttl: float):
+        """Initializes a class instance."""
+        # Users are ordered from the least to the most recently used
+        self.entries = OrderedDict()
+        self.max_users = max_users
+        self.ttl = ttl
+        self.version = None
+        # Attribute for storing cache usage counts
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+
+    def get(self, user_id: int, k: int):
+        """Returns k cached recommendations for a user (None if not cached)."""
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            expires_at, cached_k, recs = entry
+            # A list shorter than requested holds all recommendations of a user
+            if time.monotonic() < expires_at and (
+                k <= cached_k or len(recs) < cached_k
+            ):
+                self.entries.move_to_end(user_id)
+                self._stats["hits"] += 1
+                return recs[:k]
+        self._stats["misses"] += 1
+
+        return None
+
+    def put(self, user_id: int, k: int, recs: list):
+        """Caches k recommendations fetched for a user."""
+        self.entries[user_id] = (time.monotonic() + self.ttl, k, recs)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_users:
+            self.entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def set_version(self, version: str):
+        """Drops all entries if the data version of the store has changed."""
+        if self.version is not None and version != self.version:
+            self.entries.clear()
+            self._stats["invalidations"] += 1
+        self.version = version
+
+    @property
+    def stats(self):
+        """Returns cache usage counts, hit rate and size."""
+        requests = self._stats["hits"] + self._stats["misses"]
+        hit_rate = self._stats["hits"] / requests if requests else 0.0
+
+        return dict(self._stats, hit_rate=hit_rate, size=len(self.entries))
@@ -6,3 +6,122 @@ FEATURES_SERVICE_PORT = 8003
 PERSONAL_RECS_PATH = "data/recommendations.parquet"
 DEFAULT_RECS_PATH = "data/top_popular.parquet"
 ONLINE_RECS_PATH = "data/similar.parquet"
+# Connection pool sizes of the main application's clients to the stores
+RECS_STORE_POOL_SIZE = 100
+EVENTS_STORE_POOL_SIZE = 100
+FEATURES_STORE_POOL_SIZE = 200
+# Timeouts (in seconds) of a single call to each of the stores
+RECS_STORE_TIMEOUT = 2.0
+EVENTS_STORE_TIMEOUT = 1.0
+FEATURES_STORE_TIMEOUT = 1.0
+# Number of users resolved at once by the bulk offline recommendations endpoint
+BULK_RECS_CHUNK_SIZE = 10000
+# Paths to compiled snapshots of the stores (used instead of parquet if present)
+RECS_SNAPSHOT_PATH = "data/recommendations.snapshot"
+ONLINE_RECS_SNAPSHOT_PATH = "data/similar.snapshot"
+# Backend of the events store ("memory" for one worker, "sqlite" to share events
+# between several workers) and path to the database of the shared backend
+EVENTS_BACKEND_ENV = "EVENTS_STORE_BACKEND"
+EVENTS_DB_PATH = "data/events.db"
+# Memory budget (in bytes) of the in-memory events store and time (in seconds)
+# after which online history of inactive users is evicted
+EVENTS_STORE_MEMORY_BUDGET = 512 * 1024**2
+EVENTS_STORE_TTL = 24 * 60 * 60
+# Paths to the append-only log and the snapshot of the in-memory events store,
+# interval (in seconds) of group commits to the log and of log compaction
+EVENTS_LOG_PATH = "data/events.log"
+EVENTS_SNAPSHOT_PATH = "data/events.snapshot"
+EVENTS_LOG_COMMIT_INTERVAL = 0.05
+EVENTS_SNAPSHOT_INTERVAL = 10 * 60
+# Mode of the main application ("all" to load all stores into its process)
+SERVICE_MODE_ENV = "RECSYS_SERVICE_MODE"
+# Size (in users) and TTL (in seconds) of the main application's cache of offline
+# recommendations, interval (in seconds) of checking the recs store data version
+RECS_CACHE_MAX_USERS = 100000
+RECS_CACHE_TTL = 5 * 60
+RECS_CACHE_VERSION_CHECK_INTERVAL = 10
+# Interval (in seconds) of checking data files of the stores for changes to
+# reload them without a restart (0 disables watching the files)
+DATA_WATCH_INTERVAL = 60
+# Number of rows decoded at once while streaming parquet files into the stores
+PARQUET_BATCH_SIZE = 1000000
+# Mode of the offline recs store ("lazy" to decode personal recs on demand for
+# nodes short of memory), path to personal recs partitioned for it (sorted by
+# user in row groups of the given number of rows) and number of decoded row
+# groups kept in memory (bounding its memory to about groups x rows x 8 bytes)
+RECS_STORE_MODE_ENV = "RECS_STORE_MODE"
+LAZY_RECS_PATH = "data/recommendations_lazy.parquet"
+LAZY_RECS_ROW_GROUP_SIZE = 10000
+LAZY_RECS_CACHE_SIZE = 256
+# Upper bounds (in seconds) of buckets of latency histograms exposed on /metrics
+METRICS_LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+# Share of frequent events (by event) written to the log (all of them are counted
+# in recsys_log_events_total metric) and loggers written by a background thread
+# ("" being the root logger)
+LOG_SAMPLING_RATES = {
+    "recs_personal": 0.001,
+    "recs_default": 0.001,
+    "similar_tracks_miss": 0.001,
+}
+BACKGROUND_LOGGERS = ("", "uvicorn", "uvicorn.access")
+# Aggregation of scores of tracks similar to several online events ("max", "sum"
+# or "recency" summing scores weighted by RECENCY_DECAY ** age of the event) and
+# weights of online and offline recommendations in blended ones
+ONLINE_RECS_AGGREGATION = "max"
+RECENCY_DECAY = 0.8
+BLEND_WEIGHTS = {"online": 1.0, "offline": 1.0}
+# Mode of the features store ("factors" to find similar tracks of the whole
+# catalog by cosine similarity of ALS item factors instead of similar.parquet)
+# and paths to the factors (rows ordered as tracks in the item encoder)
+FEATURES_STORE_MODE_ENV = "FEATURES_STORE_MODE"
+ITEM_FACTORS_PATH = "data/item_factors.npy"
+ITEM_ENCODER_PATH = "encoders/item_encoder.pkl"
+# Approximate search of similar tracks: number of clusters of the IVF index,
+# number of closest clusters scored per query (more clusters raise recall and
+# latency), k-means iterations and sample size, catalog size below which tracks
+# are searched exactly and number of tracks scored at once by exact search
+ANN_NLIST = 1024
+ANN_NPROBE = 32
+ANN_KMEANS_ITERATIONS = 10
+ANN_TRAIN_SIZE = 50000
+ANN_MIN_ITEMS = 100000
+ANN_BLOCK_SIZE = 65536
+# Ranking of offline and online candidates at request time by the CatBoost model
+# of the notebook (by the recs store, if the model is saved): paths to the model
+# and to features of tracks (genre and play count) and genres (share of plays),
+# maximum number of offline candidates of a user, time window (in seconds) of
+# grouping model calls of concurrent requests and maximum number of candidates
+# in a group
+RANKING_MODEL_PATH = "models/ranking_model.cbm"
+TRACK_FEATURES_PATH = "data/track_features.parquet"
+GENRE_FEATURES_PATH = "data/genre_shares.parquet"
+RANKING_OFFLINE_CANDIDATES = 100
+RANKING_BATCH_WINDOW = 0.002
+RANKING_MAX_BATCH_SIZE = 10000
+# Way of combining online and offline recommendations by the main application
+# ("blend" fusing ranked lists, "rank" ranking their candidates by the model)
+RECS_COMBINING_ENV = "RECS_COMBINING"
+# Offline pipeline generating recommendations and similar tracks from ALS factors
+# (saved by the notebook): paths to user factors and the user encoder, path to
+# personal recommendations by ALS scores (unranked, unlike those served by the
+# recs store), number of users (or tracks) per chunk processed by a worker, and
+# number of tracks scored at once (a worker holding chunk x block scores)
+USER_FACTORS_PATH = "data/user_factors.npy"
+USER_ENCODER_PATH = "encoders/user_encoder.pkl"
+PIPELINE_RECS_PATH = "data/personal_als.parquet"
+PIPELINE_CHUNK_SIZE = 2000
+PIPELINE_BLOCK_SIZE = 8192
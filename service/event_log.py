@@ -0,0 +1,105 @@
+"""Append-only log of online events split into numbered segments.
+
+Events are buffered in memory and written to the active segment in groups
+(one write and fsync per group). Segments are named `<path>.<number>`, the
+active one having the largest number.
+"""
+import glob
+import os
+
+import numpy as np
+
+# Binary layout of one event record
+RECORD = np.dtype([("user_id", "<i8"), ("track_id", "<i8"), ("timestamp", "<f8")])
+
+
+class EventLog:
+    """Class for appending events to a log with group commit."""
+
+    def __init__(self, path: str):
+        """Initializes a class instance."""
+        self.path = path
+        self.buffer = []
+        # Events taken from the buffer which failed to be written
+        self.unwritten = b""
+        numbers = self.segments()
+        self.segment = numbers[-1] + 1 if numbers else 1
+        self.fd = open(self.segment_path(self.segment), "ab")
+
+    def segment_path(self, number: int):
+        """Returns the path to a segment."""
+        return f"{self.path}.{number}"
+
+    def segments(self):
+        """Returns sorted numbers of all segments on disk."""
+        paths = glob.glob(glob.escape(self.path) + ".*")
+        suffixes = [path[len(self.path) + 1 :] for path in paths]
+
+        return sorted(int(suffix) for suffix in suffixes if suffix.isdigit())
+
+    def append(self, user_id: int, track_id: int, timestamp: float):
+        """Buffers an event until the next commit."""
+        self.buffer.append((user_id, track_id, timestamp))
+
+    def take(self):
+        """Returns the buffered (and unwritten) events as bytes and empties them."""
+        data = self.unwritten + np.array(self.buffer, dtype=RECORD).tobytes()
+        self.buffer = []
+        self.unwritten = b""
+
+        return data
+
+    def untake(self, data: bytes):
+        """Returns events which failed to be written to be written next time."""
+        self.unwritten = data + self.unwritten
+
+    def write(self, data: bytes):
+        """Writes a group of events to the active segment durably."""
+        if data:
+            offset = self.fd.tell()
+            try:
+                self.fd.write(data)
+                self.fd.flush()
+                os.fsync(self.fd.fileno())
+            except OSError:
+                # Dropping a partially written group (it is written again)
+                self.fd.truncate(offset)
+                raise
+
+    def commit(self):
+        """Writes all buffered events to the active segment."""
+        data = self.take()
+        try:
+            self.write(data)
+        except Exception:
+            self.untake(data)
+            raise
+
+    def rotate(self):
+        """Closes the active segment and starts a new one."""
+        self.commit()
+        self.fd.close()
+        closed = self.segment
+        self.segment += 1
+        self.fd = open(self.segment_path(self.segment), "ab")
+
+        return closed
+
+    def remove(self, last: int):
+        """Removes all segments up to a number (inclusive)."""
+        for number in self.segments():
+            if number <= last:
+                os.remove(self.segment_path(number))
+
+    def read(self, number: int):
+        """Reads events of a segment (dropping a partially written record)."""
+        with open(self.segment_path(number), "rb") as fd:
+            data = fd.read()
+        size = len(data) // RECORD.itemsize * RECORD.itemsize
+
+        return np.frombuffer(data[:size], dtype=RECORD)
+
+    def close(self):
+        """Commits buffered events and closes the active segment."""
+        self.commit()
+        self.fd.close()
@@ -1,32 +1,470 @@
 """Service for simulating new events in online history."""
-from fastapi import FastAPI
+import asyncio
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+
+import numpy as np
+from fastapi import Body, FastAPI, HTTPException, Query, Request
+
+from .constants import (
+    EVENTS_BACKEND_ENV,
+    EVENTS_DB_PATH,
+    EVENTS_STORE_MEMORY_BUDGET,
+    EVENTS_STORE_TTL,
+    EVENTS_LOG_PATH,
+    EVENTS_SNAPSHOT_PATH,
+    EVENTS_LOG_COMMIT_INTERVAL,
+    EVENTS_SNAPSHOT_INTERVAL,
+)
+from .event_log import EventLog
+from .logs import background_logging
+from .metrics import REGISTRY, Counter, Gauge, instrument
+from .snapshot import read_snapshot, write_snapshot
+from .streaming import MAX_ID, check_ids, read_ndjson
+
+# Setting up a logger with uvicorn output stream
+logger = logging.getLogger("uvicorn.error")
+logging.basicConfig(level=logging.INFO)
+
+# Metrics of online history kept by the store
+RESIDENT_USERS = REGISTRY.register(
+    Gauge(
+        "recsys_events_resident_users",
+        "Users whose online history is kept by the events store.",
+    )
+)
+EVICTED_USERS = REGISTRY.register(
+    Counter(
+        "recsys_events_evicted_users_total",
+        "Users whose online history was evicted by reason of eviction.",
+        ("reason",),
+    )
+)
+
+
+class UserEvents:
+    """Ring buffer of the latest events of a user."""
+
+    __slots__ = ("tracks", "head", "size", "last_active")
+
+    def __init__(self, capacity: int):
+        """Initializes a class instance."""
+        self.tracks = array("q", bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+        self.last_active = 0.0
+
+    def put(self, track_id: int):
+        """Overwrites the oldest event with a new one."""
+        self.tracks[self.head] = track_id
+        self.head = (self.head + 1) % len(self.tracks)
+        self.size = min(self.size + 1, len(self.tracks))
+
+    def get(self, k: int):
+        """Returns k latest events starting from the newest one."""
+        capacity = len(self.tracks)
+
+        return [
+            self.tracks[(self.head - i) % capacity]
+            for i in range(1, min(k, self.size) + 1)
+        ]
 
 
 class EventStore:
     """Class for adding/retrieving online history."""
 
-    def __init__(self, max_events_per_user: int = 10):
+    def __init__(
+        self,
+        max_events_per_user: int = 10,
+        memory_budget: int = EVENTS_STORE_MEMORY_BUDGET,
+        ttl: float = EVENTS_STORE_TTL,
+    ):
         """Initializes a class instance."""
-        self.events = {}
+        # Users are ordered from the least to the most recently active
+        self.events = OrderedDict()
         self.max_events_per_user = max_events_per_user
+        self.ttl = ttl
+        self.max_users = max(memory_budget // self._user_size(), 1)
+        # Attribute for storing eviction counts
+        self._stats = {
+            "evicted_users_lru": 0,
+            "evicted_users_ttl": 0,
+        }
+
+    def _user_size(self):
+        """Estimates memory (in bytes) taken by the history of one user."""
+        user_events = UserEvents(self.max_events_per_user + 1)
+        # Accounting for a user identifier and a slot of the dictionary
+        return sys.getsizeof(user_events) + sys.getsizeof(user_events.tracks) + 100
+
+    def put(self, user_id: int, track_id: int, timestamp: float = None):
+        """Adds a new event for a user to the online history."""
+        now = time.time() if timestamp is None else timestamp
+        user_events = self.events.get(user_id)
+        if user_events is None:
+            user_events = UserEvents(self.max_events_per_user + 1)
+            self.events[user_id] = user_events
+        else:
+            self.events.move_to_end(user_id)
+        user_events.put(track_id)
+        user_events.last_active = now
+        self._evict(now)
+
+    def get(self, user_id: int, k: int = 5):
+        """Retrieves online history."""
+        user_events = self.events.get(user_id)
+        user_events = user_events.get(k) if user_events is not None else []
+
+        return user_events
+
+    def put_batch(self, user_ids: list, track_ids: list):
+        """Adds several events (in the order of arrival) to the online history."""
+        timestamp = time.time()
+        for user_id, track_id in zip(user_ids, track_ids):
+            self.put(user_id, track_id, timestamp)
+
+        return len(user_ids)
+
+    def _evict(self, now: float):
+        """Evicts inactive users exceeding the memory budget or the TTL."""
+        while len(self.events) > self.max_users:
+            self.events.popitem(last=False)
+            self._stats["evicted_users_lru"] += 1
+        while self.events:
+            user_events = next(iter(self.events.values()))
+            if now - user_events.last_active <= self.ttl:
+                break
+            self.events.popitem(last=False)
+            self._stats["evicted_users_ttl"] += 1
+
+    @property
+    def stats(self):
+        """Returns eviction counts and the number of resident users."""
+        return dict(self._stats, resident_users=len(self.events))
+
+    def save_snapshot(self, path: str, meta: dict = None):
+        """Saves online history of all users to a snapshot."""
+        users = list(self.events.items())
+        sizes = np.fromiter((e.size for _, e in users), np.int64, len(users))
+        offsets = np.zeros(len(users) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        # Storing events of each user from the oldest to the newest one
+        tracks = itertools.chain.from_iterable(
+            reversed(e.get(e.size)) for _, e in users
+        )
+        arrays = {
+            "user_id": np.fromiter((u for u, _ in users), np.int64, len(users)),
+            "last_active": np.fromiter(
+                (e.last_active for _, e in users), np.float64, len(users)
+            ),
+            "offsets": offsets,
+            "track_id": np.fromiter(tracks, np.int64, offsets[-1]),
+        }
+        write_snapshot(path, arrays, meta)
+
+    def load_snapshot(self, path: str):
+        """Restores online history of all users from a snapshot."""
+        arrays, meta = read_snapshot(path)
+        offsets = arrays["offsets"].tolist()
+        capacity = self.max_events_per_user + 1
+        for i, (user_id, last_active) in enumerate(
+            zip(arrays["user_id"].tolist(), arrays["last_active"].tolist())
+        ):
+            tracks = arrays["track_id"][offsets[i] : offsets[i + 1]][-capacity:]
+            user_events = UserEvents(capacity)
+            user_events.tracks[: len(tracks)] = array("q", tracks.tobytes())
+            user_events.head = len(tracks) % capacity
+            user_events.size = len(tracks)
+            user_events.last_active = last_active
+            self.events[user_id] = user_events
+
+        return meta
+
+
+class DurableEventStore(EventStore):
+    """Class for adding/retrieving online history persisted to disk.
+
+    Events are appended to a log committed in groups by a background task,
+    and closed segments of the log are periodically compacted into a snapshot.
+    """
+
+    def __init__(self, log_path: str, snapshot_path: str, **kwargs):
+        """Initializes a class instance."""
+        super().__init__(**kwargs)
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.log = None
+        self._kwargs = kwargs
+
+    def put(self, user_id: int, track_id: int, timestamp: float = None):
+        """Adds a new event for a user to the online history and the log."""
+        timestamp = time.time() if timestamp is None else timestamp
+        super().put(user_id, track_id, timestamp)
+        self.log.append(user_id, track_id, timestamp)
+
+    def _replay(self, store: EventStore, last: int = None):
+        """Applies the snapshot and log segments up to a number to a store."""
+        meta = {}
+        if os.path.exists(self.snapshot_path):
+            meta = store.load_snapshot(self.snapshot_path)
+        compacted = meta.get("last_segment", 0)
+        for number in self.log.segments():
+            if compacted < number and (last is None or number <= last):
+                for user_id, track_id, timestamp in self.log.read(number).tolist():
+                    EventStore.put(store, user_id, track_id, timestamp)
+
+    def restore(self):
+        """Restores online history from the snapshot and the log."""
+        start = time.time()
+        # Opening a new segment so that all existing ones are closed
+        self.log = EventLog(self.log_path)
+        self._replay(self, last=self.log.segment - 1)
+        logger.info(
+            f"Restored history of {len(self.events)} users "
+            f"in {time.time() - start:.2f} seconds"
+        )
+
+    def compact(self, last: int):
+        """Merges log segments up to a number into the snapshot."""
+        store = EventStore(**self._kwargs)
+        self._replay(store, last=last)
+        store.save_snapshot(self.snapshot_path, meta={"last_segment": last})
+        self.log.remove(last)
+
+    async def compact_in_background(self, last: int):
+        """Compacts log segments in a worker thread (logging failures)."""
+        try:
+            await asyncio.to_thread(self.compact, last)
+        except Exception as e:
+            logger.error(f"Compaction of events log failed: {e}")
+
+    async def persist(self):
+        """Commits the log in groups and compacts it periodically.
+
+        Compaction runs in a separate task, so commits keep their interval
+        while it replays the log. When cancelled, it waits for the running
+        commit and compaction, so that the log can then be closed safely.
+        """
+        last_compaction = time.monotonic()
+        commit = compaction = None
+        try:
+            while True:
+                await asyncio.sleep(EVENTS_LOG_COMMIT_INTERVAL)
+                data = b""
+                try:
+                    data = self.log.take()
+                    commit = asyncio.ensure_future(
+                        asyncio.to_thread(self.log.write, data)
+                    )
+                    await asyncio.shield(commit)
+                except Exception as e:
+                    # Keeping the events to write them with the next commit
+                    self.log.untake(data)
+                    logger.error(f"Commit of events log failed: {e}")
+                    continue
+                compacting = compaction is not None and not compaction.done()
+                if (
+                    not compacting
+                    and time.monotonic() - last_compaction >= EVENTS_SNAPSHOT_INTERVAL
+                ):
+                    try:
+                        closed = self.log.rotate()
+                    except Exception as e:
+                        logger.error(f"Rotation of events log failed: {e}")
+                        continue
+                    compaction = asyncio.create_task(self.compact_in_background(closed))
+                    last_compaction = time.monotonic()
+        finally:
+            running = [task for task in (commit, compaction) if task is not None]
+            if running:
+                await asyncio.wait(running)
+
+
+class SharedEventStore:
+    """Class for adding/retrieving online history shared between processes.
+
+    Writes may wait for the lock of the database held by other workers, so
+    requests put events through `put_grouped`: events of concurrent requests
+    are committed in groups (one transaction each) by a worker thread, through
+    a connection of its own, without blocking the event loop.
+    """
+
+    def __init__(self, path: str, max_events_per_user: int = 10):
+        """Initializes a class instance."""
+        self.max_events_per_user = max_events_per_user
+        # Opening a database in WAL mode (readers do not block the writer)
+        self.connection = self.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.writer = self.connect(path)
+        self.write_lock = threading.Lock()
+        # Events waiting for the next group commit and the running commit task
+        self.pending = []
+        self.committing = None
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "user_id INTEGER NOT NULL, "
+            "track_id INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS events_user ON events (user_id, seq)"
+        )
+
+    @staticmethod
+    def connect(path: str):
+        """Opens a connection to the database (usable from any thread)."""
+        connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False, timeout=30
+        )
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        return connection
 
     def put(self, user_id: int, track_id: int):
         """Adds a new event for a user to the online history."""
-        user_events = [] if self.events.get(user_id) is None else self.events[user_id]
-        self.events[user_id] = [track_id] + user_events[:self.max_events_per_user]
+        with self.write_lock, self.writer:
+            self.writer.execute("BEGIN IMMEDIATE")
+            self.writer.execute(
+                "INSERT INTO events (user_id, track_id) VALUES (?, ?)",
+                (user_id, track_id),
+            )
+            # Keeping only the latest events of the user
+            self.writer.execute(
+                "DELETE FROM events WHERE user_id = ? AND seq <= ("
+                "SELECT seq FROM events WHERE user_id = ? "
+                "ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                (user_id, user_id, self.max_events_per_user + 1),
+            )
+
+    def put_batch(self, user_ids: list, track_ids: list):
+        """Adds several events (in the order of arrival) to the online history."""
+        with self.write_lock, self.writer:
+            self.writer.execute("BEGIN IMMEDIATE")
+            self.writer.executemany(
+                "INSERT INTO events (user_id, track_id) VALUES (?, ?)",
+                zip(user_ids, track_ids),
+            )
+            # Keeping only the latest events of each user
+            self.writer.executemany(
+                "DELETE FROM events WHERE user_id = ? AND seq <= ("
+                "SELECT seq FROM events WHERE user_id = ? "
+                "ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                [
+                    (user_id, user_id, self.max_events_per_user + 1)
+                    for user_id in set(user_ids)
+                ],
+            )
+
+        return len(user_ids)
+
+    async def put_grouped(self, user_ids: list, track_ids: list):
+        """Adds events in the next group commit, waiting for it to finish."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((user_ids, track_ids, future))
+        if self.committing is None:
+            self.committing = asyncio.create_task(self.commit_groups())
+
+        return await future
+
+    async def commit_groups(self):
+        """Commits pending events in groups until there are none left.
+
+        Events put while a group is being committed form the next group.
+        """
+        while self.pending:
+            group, self.pending = self.pending, []
+            user_ids = [user_id for ids, _, _ in group for user_id in ids]
+            track_ids = [track_id for _, ids, _ in group for track_id in ids]
+            try:
+                await asyncio.to_thread(self.put_batch, user_ids, track_ids)
+            except Exception as e:
+                for _, _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for ids, _, future in group:
+                    if not future.done():
+                        future.set_result(len(ids))
+        self.committing = None
 
     def get(self, user_id: int, k: int = 5):
         """Retrieves online history."""
-        user_events = self.events[user_id][:k] if user_id in self.events else []
+        rows = self.connection.execute(
+            "SELECT track_id FROM events WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+            (user_id, k),
+        )
+        user_events = [track_id for track_id, in rows]
 
         return user_events
 
+    @property
+    def stats(self):
+        """Returns the number of resident users."""
+        (resident_users,) = self.connection.execute(
+            "SELECT COUNT(DISTINCT user_id) FROM events"
+        ).fetchone()
+
+        return {"resident_users": resident_users}
+
+
+def create_event_store():
+    """Creates an event store with the backend set for the service."""
+    if os.environ.get(EVENTS_BACKEND_ENV) == "sqlite":
+        return SharedEventStore(EVENTS_DB_PATH)
+
+    return DurableEventStore(EVENTS_LOG_PATH, EVENTS_SNAPSHOT_PATH)
+
 
 # Instantiating an object
-event_store = EventStore()
+event_store = create_event_store()
+
+
+async def put_events(user_ids: list, track_ids: list):
+    """Adds events to the store (in group commits for the shared backend)."""
+    if isinstance(event_store, SharedEventStore):
+        return await event_store.put_grouped(user_ids, track_ids)
+
+    return event_store.put_batch(user_ids, track_ids)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Restores online history on start-up and persists it in background."""
+    RESIDENT_USERS.set_function(lambda: event_store.stats["resident_users"])
+    if not isinstance(event_store, DurableEventStore):
+        with background_logging():
+            yield
+        return
+
+    event_store.restore()
+    EVICTED_USERS.set_function(lambda: event_store._stats["evicted_users_lru"], "lru")
+    EVICTED_USERS.set_function(lambda: event_store._stats["evicted_users_ttl"], "ttl")
+    task = asyncio.create_task(event_store.persist())
+
+    # Writing logs in background while serving requests
+    with background_logging():
+        yield
+
+    # Waiting for writes in progress before the final commit
+    task.cancel()
+    try:
+        with suppress(asyncio.CancelledError):
+            await task
+    finally:
+        event_store.log.close()
+
 
 # Creating an app
-app = FastAPI(title="events")
+app = FastAPI(title="events", lifespan=lifespan)
+instrument(app)
 
 
 @app.get("/healthy")
@@ -37,16 +475,58 @@ async def healthy():
 
 # Integrating endpoints for the service
 @app.post("/put")
-async def put(user_id: int, track_id: int):
+async def put(
+    user_id: int = Query(ge=0, le=MAX_ID), track_id: int = Query(ge=0, le=MAX_ID)
+):
     """Add an event (track identifier) to the history."""
-    event_store.put(user_id, track_id)
+    await put_events([user_id], [track_id])
 
     return {"result": "OK"}
 
 
+@app.post("/put_batch")
+async def put_batch(user_ids: list[int] = Body(), track_ids: list[int] = Body()):
+    """Adds several events (pairs of user and track identifiers) to the history."""
+    if len(user_ids) != len(track_ids):
+        raise HTTPException(
+            status_code=400, detail="user_ids and track_ids differ in length"
+        )
+    try:
+        check_ids(user_ids + track_ids)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    accepted = await put_events(user_ids, track_ids)
+
+    return {"result": "OK", "accepted": accepted}
+
+
+@app.post("/put_stream")
+async def put_stream(request: Request):
+    """Adds events streamed as NDJSON lines {"user_id": ..., "track_id": ...}."""
+    accepted = 0
+    try:
+        async for events in read_ndjson(request):
+            accepted += await put_events(
+                check_ids([event["user_id"] for event in events]),
+                check_ids([event["track_id"] for event in events]),
+            )
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=400, detail=f"Invalid event after {accepted} accepted"
+        )
+
+    return {"result": "OK", "accepted": accepted}
+
+
 @app.post("/get")
-async def get(user_id: int, k: int):
+async def get(user_id: int, k: int = Query(ge=0)):
     """Retrieves user events from the history."""
     events = event_store.get(user_id, k)
 
     return {"events": events}
+
+
+@app.get("/get_stats")
+async def get_stats():
+    """Displays service statistics."""
+    return event_store.stats
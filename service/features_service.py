@@ -1,11 +1,29 @@
 """Service for outputing online recommendations (track similarity)."""
+import asyncio
 import logging
+import os
+import time
 from contextlib import asynccontextmanager
 
-import pandas as pd
-from fastapi import FastAPI, Request
+import numpy as np
+from fastapi import FastAPI, HTTPException, Query, Request
 
-from .constants import ONLINE_RECS_PATH
+from .ann import ItemNeighbours
+from .constants import (
+    ONLINE_RECS_PATH,
+    ONLINE_RECS_SNAPSHOT_PATH,
+    DATA_WATCH_INTERVAL,
+    FEATURES_STORE_MODE_ENV,
+    ITEM_FACTORS_PATH,
+    ITEM_ENCODER_PATH,
+)
+from .index import RankedIndex
+from .logs import background_logging, sampled
+from .merge import merge_neighbours
+from .metrics import instrument, observe_store
+from .parquet import read_columns
+from .reload import Reloader, ReloadInProgressError, file_version, files_changed
+from .snapshot import read_snapshot, write_snapshot
 
 # Setting up a logger with uvicorn output stream
 logger = logging.getLogger("uvicorn.error")
@@ -15,41 +33,222 @@ logging.basicConfig(level=logging.INFO)
 class SimilarTracks:
     """Class for displaying online recommendations."""
 
+    # Columns (and their types) used from the file of similar tracks
+    COLUMNS = {"track_id_1": "int32", "track_id_2": "int32", "score": "float32"}
+
     def __init__(self) -> None:
         """Initializes a class instance."""
         self._similar_tracks = None
+        self._neighbours = None
+        # Attributes for storing versions of loaded data files and load time
+        self._versions = {}
+        self.loaded_at = None
+        self.load_duration = None
+        self.load_memory = {}
 
-    def load(self, path: str, **kwargs):
+    def load(self, path: str):
         """Loads online recommendatiions."""
         logger.info("Loading similarity data")
-        self._similar_tracks = pd.read_parquet(path, **kwargs)
-        self._similar_tracks = self._similar_tracks.set_index("track_id_1")
+        similar_tracks, memory = read_columns(path, self.COLUMNS)
+        # Ordering neighbours of each track by descending score
+        order = np.lexsort((-similar_tracks["score"], similar_tracks["track_id_1"]))
+        self._similar_tracks = RankedIndex.from_arrays(
+            similar_tracks["track_id_1"][order],
+            track_id_2=similar_tracks["track_id_2"][order],
+            score=similar_tracks["score"][order],
+        )
+        self._versions = {path: file_version(path)}
+        self.load_memory = {"similar": memory}
+        logger.info(
+            "Loaded similarity data "
+            f"(peak memory {memory['peak_bytes'] / 1024**2:.1f} MB, "
+            f"steady memory {memory['steady_bytes'] / 1024**2:.1f} MB)"
+        )
+
+    def load_snapshot(self, path: str):
+        """Maps online recommendations from a compiled snapshot."""
+        logger.info(f"Loading similarity snapshot: {path}")
+        arrays, _ = read_snapshot(path)
+        self._similar_tracks = RankedIndex.from_snapshot(arrays, "similar")
+        self._versions = {path: file_version(path)}
+        self.load_memory = {
+            "snapshot": {
+                "peak_bytes": 0,
+                "steady_bytes": self._similar_tracks.nbytes,
+            }
+        }
         logger.info("Loaded similarity data")
 
+    def load_factors(self, factors_path: str, encoder_path: str):
+        """Loads ALS item factors to find similar tracks of the whole catalog."""
+        # Unpickling the encoder needs scikit-learn (only in this mode)
+        import joblib
+
+        logger.info(f"Loading item factors: {factors_path}")
+        track_ids = joblib.load(encoder_path).classes_
+        self._neighbours = ItemNeighbours(track_ids, np.load(factors_path))
+        self._versions = {
+            path: file_version(path) for path in (factors_path, encoder_path)
+        }
+        self.load_memory = {
+            "factors": {"peak_bytes": 0, "steady_bytes": self._neighbours.nbytes}
+        }
+        logger.info(f"Indexed factors of {len(self._neighbours)} tracks")
+
+    def save_snapshot(self, path: str):
+        """Saves loaded online recommendations to a snapshot."""
+        write_snapshot(path, self._similar_tracks.to_snapshot("similar"))
+
+    @property
+    def version(self):
+        """Returns the version of loaded similarity data."""
+        return "/".join(self._versions[path] for path in sorted(self._versions))
+
+    def sources_changed(self):
+        """Checks if files of loaded similarity data have changed on disk."""
+        return files_changed(self._versions)
+
+    def swap(self, other):
+        """Replaces loaded similarity data with that of another instance."""
+        (
+            self._similar_tracks,
+            self._neighbours,
+            self._versions,
+            self.loaded_at,
+            self.load_duration,
+            self.load_memory,
+        ) = (
+            other._similar_tracks,
+            other._neighbours,
+            other._versions,
+            other.loaded_at,
+            other.load_duration,
+            other.load_memory,
+        )
+
+    def search_factors(self, track_ids: list, k: int):
+        """Finds k tracks most similar by item factors to each of the tracks."""
+        results = self._neighbours.search(track_ids, k)
+        missing = sum(result is None for result in results)
+        if missing and sampled("similar_tracks_miss", missing):
+            logger.info(f"{missing} of {len(track_ids)} tracks - no item factors")
+        empty = (np.array([], dtype=np.int64), np.array([], dtype=np.float32))
+
+        return [empty if result is None else result for result in results]
+
     def get(self, track_id: int, k: int = 10):
         """Retrieves first k online recommendations."""
-        try:
-            i2i = self._similar_tracks.loc[track_id].head(k)
-            i2i = i2i[["track_id_2", "score"]].to_dict(orient="list")
-        except KeyError:
-            logger.error("No recommendations found")
-            i2i = {"track_id_2": [], "score": []}
+        if self._neighbours is not None:
+            neighbours, scores = self.search_factors([track_id], k)[0]
+            return {"track_id_2": neighbours.tolist(), "score": scores.tolist()}
+
+        bounds = self._similar_tracks.locate(track_id)
+        if bounds is None:
+            # Counting tracks without neighbours (most are not covered)
+            if sampled("similar_tracks_miss"):
+                logger.info("track %s - no similar tracks", track_id)
+            return {"track_id_2": [], "score": []}
+        start, end = bounds
+        end = min(end, start + max(k, 0))
+        columns = self._similar_tracks.columns
+
+        return {
+            "track_id_2": columns["track_id_2"][start:end].tolist(),
+            "score": columns["score"][start:end].tolist(),
+        }
+
+    def get_batch(
+        self, track_ids: list, k: int = 10, merge: bool = False, how: str = "max"
+    ):
+        """Retrieves first k online recommendations for several tracks at once.
 
-        return i2i
+        If merged, scores of tracks similar to several of the tracks are
+        aggregated (see `merge.aggregate`), the tracks going from the newest.
+        """
+        if self._neighbours is not None:
+            results = self.search_factors(track_ids, k)
+            if merge:
+                sources = [np.full(len(n), i) for i, (n, _) in enumerate(results)]
+                return merge_neighbours(
+                    np.concatenate([neighbours for neighbours, _ in results]),
+                    np.concatenate([scores for _, scores in results]),
+                    np.concatenate(sources),
+                    k,
+                    how,
+                )
+            return [
+                {"track_id_2": neighbours.tolist(), "score": scores.tolist()}
+                for neighbours, scores in results
+            ]
+
+        # Locating the first k neighbours of all requested tracks in one pass
+        starts, ends, found = self._similar_tracks.locate_many(track_ids)
+        missing = len(track_ids) - int(found.sum())
+        if missing and sampled("similar_tracks_miss", missing):
+            logger.info(f"{missing} of {len(track_ids)} tracks - no similar tracks")
+        ends = np.minimum(ends, starts + max(k, 0))
+        columns = self._similar_tracks.columns
+
+        # Merging neighbours of all tracks into one list (aggregating scores)
+        if merge:
+            rows = self._similar_tracks.positions(starts, ends)
+            return merge_neighbours(
+                columns["track_id_2"][rows],
+                columns["score"][rows],
+                np.repeat(np.arange(len(track_ids)), ends - starts),
+                k,
+                how,
+            )
+
+        return [
+            {
+                "track_id_2": columns["track_id_2"][start:end].tolist(),
+                "score": columns["score"][start:end].tolist(),
+            }
+            for start, end in zip(starts, ends)
+        ]
+
+
+def load_sim_items_store():
+    """Loads similarity data from item factors, a snapshot (if compiled) or parquet."""
+    start = time.time()
+    sim_items_store = SimilarTracks()
+    if os.environ.get(FEATURES_STORE_MODE_ENV) == "factors":
+        sim_items_store.load_factors(ITEM_FACTORS_PATH, ITEM_ENCODER_PATH)
+    elif os.path.exists(ONLINE_RECS_SNAPSHOT_PATH):
+        sim_items_store.load_snapshot(path=ONLINE_RECS_SNAPSHOT_PATH)
+    else:
+        sim_items_store.load(path=ONLINE_RECS_PATH)
+    sim_items_store.loaded_at = time.time()
+    sim_items_store.load_duration = sim_items_store.loaded_at - start
+
+    return sim_items_store
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Loads data on application start-up."""
-    sim_items_store = SimilarTracks()
-    sim_items_store.load(path=ONLINE_RECS_PATH)
+    sim_items_store = load_sim_items_store()
+    sim_items_reloader = Reloader(sim_items_store, load_sim_items_store)
+    observe_store("features", sim_items_store)
+    if DATA_WATCH_INTERVAL:
+        task = asyncio.create_task(sim_items_reloader.watch(DATA_WATCH_INTERVAL))
     logger.info("Ready for online recommendations")
 
-    yield {"sim_items_store": sim_items_store}
+    # Writing logs in background while serving requests
+    with background_logging():
+        yield {
+            "sim_items_store": sim_items_store,
+            "sim_items_reloader": sim_items_reloader,
+        }
+
+    if DATA_WATCH_INTERVAL:
+        task.cancel()
 
 
 # Creating an app
 app = FastAPI(title="features", lifespan=lifespan)
+instrument(app)
 
 
 @app.get("/healthy")
@@ -60,7 +259,7 @@ async def healthy():
 
 # Adding an endpoint for online recommendations
 @app.post("/similar_tracks")
-async def similar_tracks(request: Request, track_id: int, k: int):
+async def similar_tracks(request: Request, track_id: int, k: int = Query(ge=0)):
     """Generates online recommendations."""
     # Getting an object with loaded data
     sim_items_store = request.state.sim_items_store
@@ -68,3 +267,49 @@ async def similar_tracks(request: Request, track_id: int, k: int):
     i2i = sim_items_store.get(track_id, k)
 
     return i2i
+
+
+# Adding an endpoint for online recommendations of several tracks at once
+@app.post("/similar_tracks_batch")
+async def similar_tracks_batch(
+    request: Request,
+    track_ids: list[int],
+    k: int = Query(ge=0),
+    merge: bool = False,
+    how: str = "max",
+):
+    """Generates online recommendations for a list of tracks."""
+    sim_items_store = request.state.sim_items_store
+    try:
+        i2i = sim_items_store.get_batch(track_ids, k, merge, how)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return i2i if merge else {"results": i2i}
+
+
+@app.get("/version")
+async def version(request: Request):
+    """Displays the version and load time of loaded similarity data."""
+    sim_items_store = request.state.sim_items_store
+
+    return {
+        "version": sim_items_store.version,
+        "loaded_at": sim_items_store.loaded_at,
+        "load_duration": sim_items_store.load_duration,
+        "load_memory": sim_items_store.load_memory,
+    }
+
+
+@app.post("/reload")
+async def reload(request: Request):
+    """Reloads similarity data in background (old data is served meanwhile)."""
+    sim_items_reloader = request.state.sim_items_reloader
+    try:
+        await sim_items_reloader.reload()
+    except ReloadInProgressError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Reload failed: {e}")
+
+    return await version(request)
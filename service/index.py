@@ -0,0 +1,124 @@
+"""Compact array-backed index of ranked lists used by the stores."""
+import numpy as np
+
+
+def compact(array):
+    """Downcasts an integer array to int32 if its values fit."""
+    array = np.asarray(array)
+    int32 = np.iinfo(np.int32)
+    if array.size == 0 or (array.min() >= int32.min and array.max() <= int32.max):
+        return array.astype(np.int32)
+
+    return array.astype(np.int64)
+
+
+class RankedIndex:
+    """Class for storing ranked lists of values in CSR layout.
+
+    Lists are stored back to back in contiguous column arrays, the list of
+    the i-th key (keys are sorted) occupying `offsets[i]:offsets[i + 1]`.
+    """
+
+    def __init__(self, keys, offsets, columns: dict):
+        """Initializes a class instance."""
+        self.keys = keys
+        self.offsets = offsets
+        self.columns = columns
+
+    @classmethod
+    def from_arrays(cls, keys, **columns):
+        """Builds an index from (key, value) rows keeping the order of values."""
+        # Grouping rows by key (stable sort keeps the original rank order)
+        keys = np.asarray(keys)
+        order = np.argsort(keys, kind="stable")
+        keys, counts = np.unique(keys[order], return_counts=True)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        columns = {
+            name: np.ascontiguousarray(np.asarray(column)[order])
+            for name, column in columns.items()
+        }
+
+        return cls(compact(keys), offsets, columns)
+
+    @classmethod
+    def from_snapshot(cls, arrays: dict, prefix: str):
+        """Restores an index from arrays of a snapshot."""
+        column_prefix = prefix + ".columns."
+        columns = {
+            name[len(column_prefix) :]: array
+            for name, array in arrays.items()
+            if name.startswith(column_prefix)
+        }
+
+        return cls(arrays[prefix + ".keys"], arrays[prefix + ".offsets"], columns)
+
+    def to_snapshot(self, prefix: str):
+        """Returns the index arrays named for storing in a snapshot."""
+        arrays = {prefix + ".keys": self.keys, prefix + ".offsets": self.offsets}
+        for name, column in self.columns.items():
+            arrays[prefix + ".columns." + name] = column
+
+        return arrays
+
+    def __len__(self):
+        """Returns the number of keys."""
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        """Returns the memory taken by the index arrays."""
+        arrays = [self.keys, self.offsets, *self.columns.values()]
+
+        return sum(array.nbytes for array in arrays)
+
+    def locate(self, key: int):
+        """Returns bounds of the list of a key (None if key is absent)."""
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+
+        return self.offsets[i], self.offsets[i + 1]
+
+    def locate_many(self, keys):
+        """Returns bounds of the lists of several keys and a mask of found keys."""
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys) == 0:
+            empty = np.zeros(len(keys), dtype=np.int64)
+            return empty, empty, np.zeros(len(keys), dtype=bool)
+        i = np.searchsorted(self.keys, keys)
+        i_valid = np.minimum(i, len(self.keys) - 1)
+        found = (i < len(self.keys)) & (self.keys[i_valid] == keys)
+        starts = np.where(found, self.offsets[i_valid], 0)
+        ends = np.where(found, self.offsets[i_valid + found], 0)
+
+        return starts, ends, found
+
+    @staticmethod
+    def positions(starts, ends):
+        """Returns positions of all values within several (start, end) bounds."""
+        lengths = ends - starts
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+        return shifts + np.arange(lengths.sum())
+
+    def get(self, key: int, column: str, k: int):
+        """Returns the first k values of a key's list (None if key is absent)."""
+        bounds = self.locate(key)
+        if bounds is None:
+            return None
+        start, end = bounds
+
+        return self.columns[column][start : min(end, start + max(k, 0))]
+
+    def get_many(self, keys, column: str, k: int):
+        """Returns the first k values of the lists of several keys."""
+        # Locating lists of all keys in one pass
+        starts, ends, found = self.locate_many(keys)
+        ends = np.minimum(ends, starts + max(k, 0))
+        values = self.columns[column]
+
+        return [
+            values[start:end] if is_found else None
+            for start, end, is_found in zip(starts, ends, found)
+        ]
@@ -0,0 +1,113 @@
+"""Lazy access to personal recommendations partitioned into row groups.
+
+Personal recommendations are written sorted by user_id in small row groups,
+so that only min/max user_id of each row group is kept in memory and row
+groups holding requested users are decoded on demand (keeping a bounded
+number of recently used ones).
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .index import RankedIndex
+from .parquet import present_columns, read_columns
+
+
+def write_lazy_recs(src_path: str, dst_path: str, row_group_size: int):
+    """Rewrites personal recommendations sorted by user_id in small row groups.
+
+    ALS scores (used for ranking) are kept if the source file has them.
+    """
+    columns = present_columns(
+        src_path,
+        {"user_id": "int32", "track_id": "int32", "als_score": "float32"},
+        optional=("als_score",),
+    )
+    recs, _ = read_columns(src_path, columns)
+    # Stable sort keeps the rank order of tracks of each user
+    order = np.argsort(recs["user_id"], kind="stable")
+    table = pa.table({name: column[order] for name, column in recs.items()})
+    pq.write_table(table, dst_path, row_group_size=row_group_size)
+
+
+class LazyRankedIndex:
+    """Class for looking up ranked lists of a file sorted by key on demand."""
+
+    def __init__(self, path: str, key: str, columns: dict, cache_size: int):
+        """Initializes a class instance."""
+        self.parquet_file = pq.ParquetFile(path)
+        self.key = key
+        self.columns = columns
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # Keeping only the key range of each row group in memory
+        metadata = self.parquet_file.metadata
+        key_index = metadata.schema.to_arrow_schema().get_field_index(key)
+        statistics = [
+            metadata.row_group(i).column(key_index).statistics
+            for i in range(metadata.num_row_groups)
+        ]
+        self.mins = np.array([stats.min for stats in statistics], dtype=np.int64)
+        self.maxs = np.array([stats.max for stats in statistics], dtype=np.int64)
+        # Attribute for storing row group cache usage counts
+        self._stats = {"row_group_hits": 0, "row_group_loads": 0}
+
+    def __len__(self):
+        """Returns the number of row groups."""
+        return len(self.mins)
+
+    @property
+    def nbytes(self):
+        """Returns the memory taken by the key ranges and decoded row groups."""
+        with self.lock:
+            cached = sum(index.nbytes for index in self.cache.values())
+
+        return self.mins.nbytes + self.maxs.nbytes + cached
+
+    def _row_group(self, i: int):
+        """Returns a decoded row group (loading it if it is not cached)."""
+        with self.lock:
+            index = self.cache.get(i)
+            if index is not None:
+                self.cache.move_to_end(i)
+                self._stats["row_group_hits"] += 1
+                return index
+
+        table = self.parquet_file.read_row_group(i, columns=[self.key, *self.columns])
+        index = RankedIndex.from_arrays(
+            table.column(self.key).to_numpy(),
+            **{
+                name: table.column(name).to_numpy().astype(dtype)
+                for name, dtype in self.columns.items()
+            },
+        )
+        with self.lock:
+            self.cache[i] = index
+            self._stats["row_group_loads"] += 1
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return index
+
+    def get(self, key: int, column: str, k: int):
+        """Returns the first k values of a key's list (None if key is absent)."""
+        # Row groups are sorted by key, so the candidates are consecutive
+        first = np.searchsorted(self.maxs, key, side="left")
+        last = np.searchsorted(self.mins, key, side="right")
+        values = [
+            values
+            for i in range(first, last)
+            if (values := self._row_group(i).get(key, column, k)) is not None
+        ]
+        if not values:
+            return None
+
+        return np.concatenate(values)[:k]
+
+    def get_many(self, keys, column: str, k: int):
+        """Returns the first k values of the lists of several keys."""
+        return [self.get(key, column, k) for key in keys]
@@ -0,0 +1,64 @@
+"""Logging kept off the hot path of the services.
+
+Log records are handed over to a queue and formatted and written by a
+background thread, and frequent events (e.g. a user without personal recs) are
+counted in a metric while only a sample of them is logged.
+"""
+import logging
+import queue
+import random
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+from .constants import LOG_SAMPLING_RATES, BACKGROUND_LOGGERS
+from .metrics import REGISTRY, Counter
+
+# Metric of frequent events (counted whether they are logged or not)
+LOG_EVENTS = REGISTRY.register(
+    Counter(
+        "recsys_log_events_total",
+        "Frequent events of the services (only a sample of them is logged).",
+        ("event",),
+    )
+)
+
+
+def sampled(event: str, count: int = 1):
+    """Counts occurrences of an event and tells if they are to be logged."""
+    LOG_EVENTS.inc(event, amount=count)
+    rate = LOG_SAMPLING_RATES.get(event, 1.0)
+
+    return rate >= 1.0 or random.random() < rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler leaving formatting of records to the background thread."""
+
+    def prepare(self, record: logging.LogRecord):
+        """Passes a record as is (it is handled within the same process)."""
+        return record
+
+
+@contextmanager
+def background_logging(logger_names: tuple = BACKGROUND_LOGGERS):
+    """Writes records of loggers in a background thread while in the context."""
+    listeners = []
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        handlers = logger.handlers
+        # Skipping loggers without handlers or already logging in background
+        if not handlers or any(isinstance(h, QueueHandler) for h in handlers):
+            continue
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, *handlers, respect_handler_level=True)
+        logger.handlers = [DeferredQueueHandler(records)]
+        listener.start()
+        listeners.append((logger, handlers, listener))
+
+    try:
+        yield
+    finally:
+        # Writing the remaining records and restoring the handlers
+        for logger, handlers, listener in listeners:
+            listener.stop()
+            logger.handlers = handlers
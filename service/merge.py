@@ -0,0 +1,80 @@
+"""Vectorized merging of candidate lists into top-k recommendations."""
+import numpy as np
+
+from .constants import RECENCY_DECAY
+
+# Ways of aggregating scores of a candidate found in several lists
+AGGREGATIONS = ("max", "sum", "recency")
+
+
+def aggregate(candidates, scores, how: str = "max", sources=None):
+    """Aggregates scores of candidates repeated in several lists.
+
+    With "recency", scores are summed after weighting each one by
+    `RECENCY_DECAY ** source`, the source being the index of the list (e.g.
+    of the event, 0 for the newest one) the candidate comes from.
+    Returns unique candidates, their scores and their first positions.
+    """
+    if how not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{how}', use one of {AGGREGATIONS}")
+    scores = np.asarray(scores, dtype=np.float64)
+    if how == "recency":
+        scores = scores * RECENCY_DECAY ** np.asarray(sources)
+    unique, first, inverse = np.unique(
+        np.asarray(candidates), return_index=True, return_inverse=True
+    )
+    if how == "max":
+        totals = np.full(len(unique), -np.inf)
+        np.maximum.at(totals, inverse, scores)
+    else:
+        totals = np.bincount(inverse, weights=scores, minlength=len(unique))
+
+    return unique, totals, first
+
+
+def top_k(scores, k: int, ties=None):
+    """Returns indices of the k highest scores in descending order.
+
+    Equal scores are ordered by ascending `ties` (by index if not set).
+    """
+    ties = np.arange(len(scores)) if ties is None else ties
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    # Selecting the k highest scores (with all ties of the k-th one) unsorted
+    if k < len(scores):
+        kth = -np.partition(-scores, k - 1)[k - 1]
+        indices = np.flatnonzero(scores >= kth)
+    else:
+        indices = np.arange(len(scores))
+    order = np.lexsort((ties[indices], -scores[indices]))
+
+    return indices[order][:k]
+
+
+def merge_neighbours(neighbours, scores, sources, k: int, how: str):
+    """Merges neighbours of several tracks into the k best ones."""
+    neighbours, scores, first = aggregate(neighbours, scores, how, sources)
+    best = top_k(scores, k, first)
+
+    return {"track_id_2": neighbours[best].tolist(), "score": scores[best].tolist()}
+
+
+def blend(ranked_lists: list, weights: list, k: int):
+    """Fuses ranked lists of candidates into k best ones.
+
+    A candidate gets `weight / rank` from each list it is in (ranks start from
+    1), so that with equal weights the lists are interleaved (the first list
+    going first) and candidates found in several lists move up.
+    """
+    candidates = np.concatenate(
+        [np.asarray(ids, dtype=np.int64) for ids in ranked_lists]
+    )
+    scores = np.concatenate(
+        [
+            weight / np.arange(1, len(ids) + 1)
+            for ids, weight in zip(ranked_lists, weights)
+        ]
+    )
+    unique, totals, first = aggregate(candidates, scores, "sum")
+
+    return unique[top_k(totals, k, first)].tolist()
@@ -0,0 +1,303 @@
+"""Metrics of the services exposed in Prometheus text format on `/metrics`.
+
+Metrics are plain Python counters updated from the event loop of a service
+(so no locks are taken), and values owned by the stores (sizes, load times,
+cache counts) are read by callbacks only when metrics are scraped. Each
+process (e.g. each worker) keeps its own metrics.
+"""
+import functools
+import time
+from bisect import bisect_left
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+from .constants import METRICS_LATENCY_BUCKETS
+
+# Content type of Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names: tuple, values: tuple):
+    """Formats label names and values as `{name="value",...}`."""
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", r"\\").replace('"', r"\"")
+        value = value.replace("\n", r"\n")
+        pairs.append(f'{name}="{value}"')
+
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    """Formats a sample value (infinity as `+Inf`)."""
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class of metrics with values per combination of labels."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        """Initializes a class instance."""
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.functions = {}
+
+    def set_function(self, function, *labelvalues):
+        """Makes a value to be read from a function each time it is scraped."""
+        self.functions[labelvalues] = function
+
+    def samples(self):
+        """Returns (suffix, label names, label values, value) of all samples."""
+        values = dict(self.values)
+        for labelvalues, function in self.functions.items():
+            values[labelvalues] = function()
+
+        return [
+            ("", self.labelnames, labelvalues, value)
+            for labelvalues, value in values.items()
+            if value is not None
+        ]
+
+    def render(self):
+        """Returns the metric in Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            labels = format_labels(names, values)
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """Class for a monotonically increasing count."""
+
+    type = "counter"
+
+    def inc(self, *labelvalues, amount: int = 1):
+        """Increases the count of a combination of labels."""
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    """Class for a value which goes up and down."""
+
+    type = "gauge"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        """Increases the value of a combination of labels."""
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1):
+        """Decreases the value of a combination of labels."""
+        self.values[labelvalues] = self.values.get(labelvalues, 0) - amount
+
+    def set(self, value: float, *labelvalues):
+        """Sets the value of a combination of labels."""
+        self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    """Class for counting observed values in buckets (e.g. latencies)."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets=()):
+        """Initializes a class instance."""
+        super().__init__(name, help, labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, *labelvalues):
+        """Counts a value in the first bucket it fits into."""
+        counts = self.values.get(labelvalues)
+        if counts is None:
+            # Counts of buckets (the last one is +Inf), then sum of values
+            counts = self.values[labelvalues] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        """Returns cumulative bucket counts, sum and count of each label set."""
+        samples = []
+        bucket_names = self.labelnames + ("le",)
+        for labelvalues, counts in list(self.values.items()):
+            cumulative = 0
+            for le, count in zip([*self.buckets, float("inf")], counts[:-1]):
+                cumulative += count
+                le = format_value(float(le))
+                samples.append(
+                    ("_bucket", bucket_names, labelvalues + (le,), cumulative)
+                )
+            samples.append(("_sum", self.labelnames, labelvalues, counts[-1]))
+            samples.append(("_count", self.labelnames, labelvalues, cumulative))
+
+        return samples
+
+
+class Registry:
+    """Class for keeping all metrics of a process."""
+
+    def __init__(self):
+        """Initializes a class instance."""
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        """Adds a metric (or returns the already added one of the same name)."""
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """Returns all metrics in Prometheus text format."""
+        return "".join(metric.render() for metric in self.metrics.values())
+
+
+REGISTRY = Registry()
+
+# Metrics of requests to the services
+REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "recsys_request_duration_seconds",
+        "Duration of requests to the service endpoints.",
+        ("service", "endpoint"),
+        METRICS_LATENCY_BUCKETS,
+    )
+)
+REQUESTS = REGISTRY.register(
+    Counter(
+        "recsys_requests_total",
+        "Requests to the service endpoints by response status.",
+        ("service", "endpoint", "status"),
+    )
+)
+REQUESTS_IN_FLIGHT = REGISTRY.register(
+    Gauge(
+        "recsys_requests_in_flight",
+        "Requests being processed by the service.",
+        ("service",),
+    )
+)
+
+# Metrics of calls of the main application to the stores
+STORE_CALL_DURATION = REGISTRY.register(
+    Histogram(
+        "recsys_store_call_duration_seconds",
+        "Duration of calls of the main application to the stores.",
+        ("store", "call"),
+        METRICS_LATENCY_BUCKETS,
+    )
+)
+STORE_CALL_ERRORS = REGISTRY.register(
+    Counter(
+        "recsys_store_call_errors_total",
+        "Calls of the main application to the stores which failed.",
+        ("store", "call"),
+    )
+)
+
+# Metrics of data loaded by the stores
+STORE_MEMORY = REGISTRY.register(
+    Gauge(
+        "recsys_store_memory_bytes",
+        "Memory taken by data loaded by the store.",
+        ("store",),
+    )
+)
+STORE_LOAD_DURATION = REGISTRY.register(
+    Gauge(
+        "recsys_store_load_duration_seconds",
+        "Duration of the latest load of data by the store.",
+        ("store",),
+    )
+)
+STORE_LOADED_AT = REGISTRY.register(
+    Gauge(
+        "recsys_store_loaded_timestamp_seconds",
+        "Time of the latest load of data by the store.",
+        ("store",),
+    )
+)
+
+
+def observe_store(store: str, data_store):
+    """Exposes the memory and load time of data of a store."""
+    STORE_MEMORY.set_function(
+        lambda: sum(m["steady_bytes"] for m in data_store.load_memory.values()),
+        store,
+    )
+    STORE_LOAD_DURATION.set_function(lambda: data_store.load_duration, store)
+    STORE_LOADED_AT.set_function(lambda: data_store.loaded_at, store)
+
+
+def timed(store: str, call: str):
+    """Decorates an async call to a store to time it (and count failures)."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                STORE_CALL_ERRORS.inc(store, call)
+                raise
+            finally:
+                STORE_CALL_DURATION.observe(time.perf_counter() - start, store, call)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing requests to each endpoint of a service."""
+
+    def __init__(self, app, service: str):
+        """Initializes a class instance."""
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        """Handles a request counting it as in flight until it is answered."""
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc(self.service)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec(self.service)
+            # Labelling by route template (the router stores it in the scope)
+            route = scope.get("route")
+            endpoint = scope.get("root_path", "") + route.path if route else "other"
+            REQUEST_DURATION.observe(
+                time.perf_counter() - start, self.service, endpoint
+            )
+            REQUESTS.inc(self.service, endpoint, status)
+
+
+async def metrics():
+    """Displays metrics of the process in Prometheus text format."""
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+def instrument(app: FastAPI):
+    """Adds timing of requests and `/metrics` endpoint to a service."""
+    app.add_middleware(MetricsMiddleware, service=app.title)
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
@@ -0,0 +1,61 @@
+"""Reading selected columns of parquet files into compact NumPy arrays."""
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .constants import PARQUET_BATCH_SIZE
+
+
+def downcast(array, dtype: str):
+    """Casts an Arrow array to a NumPy dtype (int32 ids are kept int64 if needed)."""
+    if dtype == "int32":
+        try:
+            array = pc.cast(array, pa.int32(), safe=True)
+        except pa.ArrowInvalid:
+            array = pc.cast(array, pa.int64())
+    else:
+        array = pc.cast(array, pa.from_numpy_dtype(np.dtype(dtype)), safe=False)
+
+    return array.to_numpy(zero_copy_only=False)
+
+
+def present_columns(path: str, columns: dict, optional: tuple = ()):
+    """Drops optional columns (name => dtype) missing from a parquet file."""
+    names = pq.read_schema(path).names
+
+    return {
+        name: dtype
+        for name, dtype in columns.items()
+        if name in names or name not in optional
+    }
+
+
+def read_columns(path: str, columns: dict, batch_size: int = PARQUET_BATCH_SIZE):
+    """Reads columns (name => dtype) of a parquet file batch by batch.
+
+    Returns arrays of the columns and the peak and steady memory (in bytes)
+    taken while loading them.
+    """
+    chunks = {name: [] for name in columns}
+    chunks_size = 0
+    peak = 0
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, columns=list(columns)
+    ):
+        for name, dtype in columns.items():
+            chunk = downcast(batch.column(name), dtype)
+            chunks[name].append(chunk)
+            chunks_size += chunk.nbytes
+        peak = max(peak, chunks_size + pa.total_allocated_bytes())
+
+    # Concatenating chunks (both copies exist at once for a moment)
+    arrays = {
+        name: np.concatenate(chunks[name]) if chunks[name] else np.array([], dtype)
+        for name, dtype in columns.items()
+    }
+    steady = sum(array.nbytes for array in arrays.values())
+    memory = {"peak_bytes": max(peak, chunks_size + steady), "steady_bytes": steady}
+
+    return arrays, memory
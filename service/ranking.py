@@ -0,0 +1,214 @@
+"""Re-ranking of candidate tracks at request time by the CatBoost model.
+
+Candidates of a user (offline recommendations with their ALS scores and tracks
+similar to online events) get the features the model of the notebook was
+trained on and are ordered by its predictions.
+Predictions for concurrent requests are grouped into micro-batches, so that
+the model is called once per batch rather than once per request.
+"""
+import asyncio
+import logging
+
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from .merge import top_k
+from .parquet import downcast, read_columns
+
+try:
+    import pandas as pd
+    from catboost import CatBoostClassifier, Pool
+except ImportError:
+    # Ranking is unavailable without catboost (recommendations stay unranked)
+    CatBoostClassifier = None
+
+# Setting up a logger with uvicorn output stream
+logger = logging.getLogger("uvicorn.error")
+
+
+class RankingUnavailableError(Exception):
+    """Raised when candidates are to be ranked without a loaded model."""
+
+
+class Ranker:
+    """Class for scoring candidate tracks of users by the ranking model."""
+
+    # Features of the model (in its order) and the categorical ones
+    FEATURES = ["als_score", "genre", "genre_share", "count"]
+    CAT_FEATURES = ["genre"]
+    # Genre of tracks missing from the features table
+    UNKNOWN_GENRE = "unknown"
+
+    def __init__(self) -> None:
+        """Initializes a class instance."""
+        self.model = None
+        self._track_ids = None
+        self._genres = None
+        self._counts = None
+        self._genre_names = None
+        self._genre_shares = None
+
+    def load(self, model_path: str, track_features_path: str, genre_features_path: str):
+        """Loads the model and features of tracks and genres."""
+        if CatBoostClassifier is None:
+            raise RankingUnavailableError("catboost is not installed")
+        logger.info(f"Loading ranking model: {model_path}")
+        self.model = CatBoostClassifier()
+        self.model.load_model(model_path)
+
+        # Genres (as codes of genre names) and play counts of tracks by track_id
+        tracks = pq.read_table(track_features_path, columns=["track_id", "genre"])
+        tracks = tracks.combine_chunks()
+        track_ids = downcast(tracks.column("track_id").chunk(0), "int32")
+        genres = pc.dictionary_encode(tracks.column("genre").chunk(0))
+        counts, _ = read_columns(track_features_path, {"count": "float32"})
+        order = np.argsort(track_ids)
+        self._track_ids = track_ids[order]
+        # Tracks without a genre get the code of unknown genre (the last one)
+        codes = pc.fill_null(genres.indices, len(genres.dictionary))
+        self._genres = codes.to_numpy(zero_copy_only=False)[order]
+        self._counts = counts["count"][order]
+
+        # Shares of genres in the order of genre codes (unknown genres last)
+        shares = pq.read_table(genre_features_path).to_pydict()
+        share_by_genre = dict(zip(shares["genre"], shares["genre_share"]))
+        self._genre_names = np.array(
+            [*genres.dictionary.to_pylist(), self.UNKNOWN_GENRE], dtype=object
+        )
+        self._genre_shares = np.array(
+            [share_by_genre.get(genre, np.nan) for genre in self._genre_names],
+            dtype=np.float32,
+        )
+        logger.info(f"Loaded features of {len(self._track_ids)} tracks for ranking")
+
+    @property
+    def nbytes(self):
+        """Returns the memory taken by the features."""
+        arrays = [self._track_ids, self._genres, self._counts, self._genre_shares]
+
+        return sum(array.nbytes for array in arrays)
+
+    def __len__(self):
+        """Returns the number of tracks with features."""
+        return len(self._track_ids)
+
+    def candidates(self, offline, offline_scores, track_ids: list):
+        """Returns candidates of a user and their ALS scores.
+
+        Offline recommendations of the user (default ones if there are none)
+        go first, followed by the given (online) candidates which are not
+        among them. Default and online candidates have no ALS score (NaN), as
+        their similarity scores differ from ALS ones in scale and meaning.
+        """
+        offline = np.asarray(offline)
+        if offline_scores is None:
+            offline_scores = np.full(len(offline), np.nan, dtype=np.float32)
+        candidates = np.concatenate([offline, np.asarray(track_ids, dtype=np.int64)])
+        als_scores = np.concatenate(
+            [offline_scores, np.full(len(track_ids), np.nan, dtype=np.float32)]
+        )
+        # Keeping the first occurrence of each track
+        _, first = np.unique(candidates, return_index=True)
+        first = np.sort(first)
+
+        return candidates[first], als_scores[first]
+
+    def features(self, track_ids, als_scores):
+        """Returns features of candidate tracks as columns of the model."""
+        i = np.minimum(np.searchsorted(self._track_ids, track_ids), len(self) - 1)
+        known = self._track_ids[i] == track_ids
+        genres = np.where(known, self._genres[i], len(self._genre_names) - 1)
+
+        return {
+            "als_score": np.asarray(als_scores, dtype=np.float32),
+            "genre": self._genre_names[genres],
+            "genre_share": self._genre_shares[genres],
+            "count": np.where(known, self._counts[i], np.nan),
+        }
+
+    def predict(self, features: dict):
+        """Predicts probabilities of listening to candidates."""
+        data = pd.DataFrame({name: features[name] for name in self.FEATURES})
+        pool = Pool(data=data, cat_features=self.CAT_FEATURES)
+
+        return self.model.predict_proba(pool)[:, 1]
+
+
+class MicroBatcher:
+    """Class for grouping calls of a function made by concurrent requests.
+
+    Inputs (dicts of equally long arrays) submitted within `window` seconds
+    of the first pending one (or until `max_size` rows are pending) are
+    concatenated, passed to the function at once in a worker thread, and its
+    output array is split back between the callers.
+    """
+
+    def __init__(self, function, window: float, max_size: int) -> None:
+        """Initializes a class instance."""
+        self.function = function
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self.pending_size = 0
+        self.flush_handle = None
+        self.tasks = set()
+        # Attribute for storing numbers of calls and batches
+        self._stats = {"calls": 0, "batches": 0, "rows": 0}
+
+    async def submit(self, inputs: dict):
+        """Waits for the output of the function for the inputs."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((inputs, future))
+        self.pending_size += len(next(iter(inputs.values())))
+        if self.pending_size >= self.max_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.window, self.flush
+            )
+
+        return await future
+
+    def flush(self):
+        """Starts calling the function with all pending inputs."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending, self.pending_size = self.pending, [], 0
+        if batch:
+            # Keeping references to running batches until they are done
+            task = asyncio.create_task(self.run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: list):
+        """Calls the function with a batch of inputs and resolves its callers."""
+        names = batch[0][0].keys()
+        inputs = {
+            name: np.concatenate([call_inputs[name] for call_inputs, _ in batch])
+            for name in names
+        }
+        sizes = [len(next(iter(call_inputs.values()))) for call_inputs, _ in batch]
+        self._stats["calls"] += len(batch)
+        self._stats["batches"] += 1
+        self._stats["rows"] += sum(sizes)
+        try:
+            outputs = await asyncio.to_thread(self.function, inputs)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), output in zip(batch, np.split(outputs, np.cumsum(sizes)[:-1])):
+            if not future.done():
+                future.set_result(output)
+
+
+async def rank(ranker: Ranker, batcher: MicroBatcher, candidates, k: int):
+    """Orders candidates (track ids and ALS scores) by the model, returning k best."""
+    track_ids, als_scores = candidates
+    scores = await batcher.submit(ranker.features(track_ids, als_scores))
+
+    return track_ids[top_k(np.asarray(scores), k)].tolist()
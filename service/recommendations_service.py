@@ -1,115 +1,227 @@
 """Main application: launching different recommendation services."""
-import requests
-from requests.exceptions import ConnectionError
-from fastapi import FastAPI
+import asyncio
+import os
+from contextlib import asynccontextmanager
 
+import httpx
+from fastapi import FastAPI, Query, Request
+
+from . import events_service, features_service, recs_offline_service
+from .cache import RecsCache
 from .constants import (
-    BASE_URL,
-    RECS_OFFLINE_SERVICE_PORT,
-    EVENTS_SERVICE_PORT,
-    FEATURES_SERVICE_PORT,
+    SERVICE_MODE_ENV,
+    RECS_CACHE_MAX_USERS,
+    RECS_CACHE_TTL,
+    RECS_CACHE_VERSION_CHECK_INTERVAL,
+    ONLINE_RECS_AGGREGATION,
+    BLEND_WEIGHTS,
+    RECS_COMBINING_ENV,
+)
+from .logs import background_logging
+from .merge import blend
+from .metrics import REGISTRY, Counter, Gauge, instrument
+from .stores import HttpStores, LocalStores
+
+# Running all stores in the process of the main application ("all" mode)
+ALL_IN_ONE = os.environ.get(SERVICE_MODE_ENV) == "all"
+# Ranking online and offline candidates by the model of the recs store instead
+# of blending ranked lists of them
+RANK_CANDIDATES = os.environ.get(RECS_COMBINING_ENV) == "rank"
+
+# Metrics of the cache of offline recommendations
+RECS_CACHE_REQUESTS = REGISTRY.register(
+    Counter(
+        "recsys_recs_cache_requests_total",
+        "Lookups in the cache of offline recommendations by result.",
+        ("result",),
+    )
+)
+RECS_CACHE_EVICTIONS = REGISTRY.register(
+    Counter(
+        "recsys_recs_cache_evictions_total",
+        "Users evicted from the full cache of offline recommendations.",
+    )
+)
+RECS_CACHE_INVALIDATIONS = REGISTRY.register(
+    Counter(
+        "recsys_recs_cache_invalidations_total",
+        "Clearings of the cache on changes of the recs store data.",
+    )
+)
+RECS_CACHE_HIT_RATE = REGISTRY.register(
+    Gauge(
+        "recsys_recs_cache_hit_rate",
+        "Share of lookups served by the cache of offline recommendations.",
+    )
+)
+RECS_CACHE_SIZE = REGISTRY.register(
+    Gauge(
+        "recsys_recs_cache_size",
+        "Users kept in the cache of offline recommendations.",
+    )
 )
 
-headers = {"Content-type": "application/json", "Accept": "text/plain"}
-recommendations_url = BASE_URL + ":" + str(RECS_OFFLINE_SERVICE_PORT)
-events_url = BASE_URL + ":" + str(EVENTS_SERVICE_PORT)
-features_url = BASE_URL + ":" + str(FEATURES_SERVICE_PORT)
 
-# Creating an app
-app = FastAPI(title="recommendations_main")
+def observe_recs_cache(recs_cache: RecsCache):
+    """Exposes usage counts and size of the cache as metrics."""
+    RECS_CACHE_REQUESTS.set_function(lambda: recs_cache._stats["hits"], "hit")
+    RECS_CACHE_REQUESTS.set_function(lambda: recs_cache._stats["misses"], "miss")
+    RECS_CACHE_EVICTIONS.set_function(lambda: recs_cache._stats["evictions"])
+    RECS_CACHE_INVALIDATIONS.set_function(lambda: recs_cache._stats["invalidations"])
+    RECS_CACHE_HIT_RATE.set_function(lambda: recs_cache.stats["hit_rate"])
+    RECS_CACHE_SIZE.set_function(lambda: len(recs_cache.entries))
+
+
+@asynccontextmanager
+async def open_stores(app: FastAPI):
+    """Connects to the stores (or loads them into the process)."""
+    if not ALL_IN_ONE:
+        stores = HttpStores()
+        yield stores, {}
+        await stores.close()
+        return
+
+    # Loading the stores the same way their own services do
+    async with (
+        recs_offline_service.lifespan(app) as recs_state,
+        features_service.lifespan(app) as features_state,
+        events_service.lifespan(app),
+    ):
+        stores = LocalStores(
+            rec_store=recs_state["rec_store"],
+            rec_batcher=recs_state["rec_batcher"],
+            sim_items_store=features_state["sim_items_store"],
+            event_store=events_service.event_store,
+        )
+        yield stores, {**recs_state, **features_state}
+
+
+async def check_recs_version(stores, recs_cache: RecsCache):
+    """Invalidates cached offline recommendations when the recs store data changes."""
+    while True:
+        try:
+            recs_cache.set_version(await stores.get_version())
+        except (httpx.HTTPError, ValueError, KeyError):
+            pass
+        await asyncio.sleep(RECS_CACHE_VERSION_CHECK_INTERVAL)
 
 
-def dedup_ids(ids):
-    """Removes duplicates from a list."""
-    seen = set()
-    ids = [id for id in ids if not (id in seen or seen.add(id))]
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Connects to the stores and starts caching offline recommendations."""
+    async with open_stores(app) as (stores, state):
+        recs_cache = RecsCache(RECS_CACHE_MAX_USERS, RECS_CACHE_TTL)
+        observe_recs_cache(recs_cache)
+        task = asyncio.create_task(check_recs_version(stores, recs_cache))
 
-    return ids
+        # Writing logs in background while serving requests
+        with background_logging():
+            yield {"stores": stores, "recs_cache": recs_cache, **state}
+
+        task.cancel()
+
+
+# Creating an app
+app = FastAPI(title="recommendations_main", lifespan=lifespan)
+instrument(app)
+
+# Exposing endpoints of the stores (sharing the loaded data) in "all" mode
+if ALL_IN_ONE:
+    app.mount("/recs_store", recs_offline_service.app)
+    app.mount("/features_store", features_service.app)
+    app.mount("/events_store", events_service.app)
 
 
 @app.get("/stats")
-async def stats():
-    response = requests.get(recommendations_url + "/get_stats")
-    return response.json()
+async def stats(request: Request):
+    stores = request.state.stores
+    recs_cache = request.state.recs_cache
+    response = await stores.get_stats()
+    return {**response, "cache": recs_cache.stats}
 
 
 @app.get("/healthy")
-async def healthy():
+async def healthy(request: Request):
     """Displays status message."""
+    stores = request.state.stores
     # Verifying connection to all services
-    try:
-        response = requests.get(recommendations_url + "/healthy")
-        response = requests.get(events_url + "/healthy")
-        response = requests.get(features_url + "/healthy")
-    except ConnectionError:
-        return {"status": "unhealthy"}
-    else:
+    if await stores.healthy():
         return {"status": "healthy"}
+    else:
+        return {"status": "unhealthy"}
 
 
 @app.post("/recommendations_offline")
-async def recommendations_offline(user_id: int, k: int = 5):
+async def recommendations_offline(
+    request: Request, user_id: int, k: int = Query(5, ge=0)
+):
     """Displays k offline recommendations."""
-    params = {"user_id": user_id, "k": k}
-    response = requests.post(
-        recommendations_url + "/get_recs", params=params, headers=headers
-    )
-    response = response.json()
+    stores = request.state.stores
+    recs_cache = request.state.recs_cache
+    # Fetching recommendations from the store only if they are not cached
+    response = recs_cache.get(user_id, k)
+    if response is None:
+        version = recs_cache.version
+        response = await stores.get_recs(user_id, k)
+        # Not caching recommendations of data replaced during the fetch
+        if recs_cache.version == version:
+            recs_cache.put(user_id, k, response)
 
     return {"recs": response}
 
 
-@app.post("/recommendations_online")
-async def recommendations_online(user_id: int, k: int = 5, num_events: int = 3):
-    """Displays k online recommendations based on last online events."""
+async def online_candidates(stores, user_id: int, k: int, num_events: int = 3):
+    """Retrieves k tracks similar to last online events of a user with scores."""
     # Retrieving the online history for a user
-    params = {"user_id": user_id, "k": num_events}
-    response = requests.post(events_url + "/get", params=params, headers=headers)
-    events = response.json()
-    events = events["events"]
-
-    # Getting online recommendations for each event (track)
-    tracks = []
-    scores = []
-    for track_id in events:
-        params = {"track_id": track_id, "k": k}
-        response = requests.post(
-            features_url + "/similar_tracks", headers=headers, params=params
-        )
-        response = response.json()
-        tracks += response["track_id_2"]
-        scores += response["score"]
-    combined = list(zip(tracks, scores))
-    combined = sorted(combined, key=lambda x: x[1], reverse=True)
-    combined = [track for track, _ in combined]
+    events = await stores.get_events(user_id, num_events)
 
-    # Removing duplicates from recommendations
-    combined = dedup_ids(combined)
+    if events == []:
+        return {"track_id_2": [], "score": []}
 
-    return {"recs": combined[:k]}
+    # Getting online recommendations for all events (tracks) in one call, scores
+    # of tracks similar to several events being aggregated
+    return await stores.similar_tracks(events, k, ONLINE_RECS_AGGREGATION)
+
+
+@app.post("/recommendations_online")
+async def recommendations_online(
+    request: Request,
+    user_id: int,
+    k: int = Query(5, ge=0),
+    num_events: int = Query(3, ge=0),
+):
+    """Displays k online recommendations based on last online events."""
+    stores = request.state.stores
+    response = await online_candidates(stores, user_id, k, num_events)
+
+    return {"recs": response["track_id_2"]}
 
 
 @app.post("/recommendations")
-async def recommendations(user_id: int, k: int = 50):
+async def recommendations(request: Request, user_id: int, k: int = Query(50, ge=0)):
     """Computes recommendations based on online/offline history."""
-    # Computing both types of recommendations
-    result_online = await recommendations_online(user_id=user_id, k=k)
-    result_offline = await recommendations_offline(user_id=user_id, k=k)
+    stores = request.state.stores
+    # Ranking online and offline candidates by the model (if it is loaded)
+    if RANK_CANDIDATES:
+        online = await online_candidates(stores, user_id, k)
+        recs = await stores.get_recs_ranked(user_id, k, online["track_id_2"])
+        if recs is not None:
+            return {"recs": recs}
+
+    # Computing both types of recommendations concurrently
+    result_online, result_offline = await asyncio.gather(
+        recommendations_online(request, user_id=user_id, k=k, num_events=3),
+        recommendations_offline(request, user_id=user_id, k=k),
+    )
     # Stopping if there is no online history
     if result_online["recs"] == []:
         return {"recs": result_offline["recs"]}
 
     # Blending online and offline recommendations (if online history present)
-    recs_online = result_online["recs"]
-    recs_offline = result_offline["recs"]
-
-    recs_blended = []
-    min_length = min(len(recs_offline), len(recs_online))
-    for i in range(min_length):
-        recs_blended.append(recs_online[i])
-        recs_blended.append(recs_offline[i])
-
-    # Removing duplicates
-    recs_blended = dedup_ids(recs_blended)
+    recs_blended = blend(
+        [result_online["recs"], result_offline["recs"]],
+        [BLEND_WEIGHTS["online"], BLEND_WEIGHTS["offline"]],
+        k,
+    )
 
-    return {"recs": recs_blended[:k]}
+    return {"recs": recs_blended}
@@ -1,20 +1,84 @@
 """Service for outputing offline recommendations (personal and top-popular)."""
+import asyncio
+import json
 import logging
+import os
+import time
 from contextlib import asynccontextmanager
 
-import pandas as pd
-from fastapi import FastAPI, Request
+from fastapi import Body, FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 
-from .constants import PERSONAL_RECS_PATH, DEFAULT_RECS_PATH
+from .constants import (
+    PERSONAL_RECS_PATH,
+    DEFAULT_RECS_PATH,
+    RECS_SNAPSHOT_PATH,
+    RECS_STORE_MODE_ENV,
+    LAZY_RECS_PATH,
+    LAZY_RECS_CACHE_SIZE,
+    BULK_RECS_CHUNK_SIZE,
+    DATA_WATCH_INTERVAL,
+    RANKING_MODEL_PATH,
+    TRACK_FEATURES_PATH,
+    GENRE_FEATURES_PATH,
+    RANKING_OFFLINE_CANDIDATES,
+    RANKING_BATCH_WINDOW,
+    RANKING_MAX_BATCH_SIZE,
+)
+from .index import RankedIndex
+from .lazy import LazyRankedIndex
+from .logs import background_logging, sampled
+from .metrics import REGISTRY, Counter, instrument, observe_store
+from .parquet import present_columns, read_columns
+from .ranking import MicroBatcher, Ranker, RankingUnavailableError, rank
+from .reload import Reloader, ReloadInProgressError, file_version, files_changed
+from .snapshot import read_snapshot, write_snapshot
+from .streaming import check_ids, is_ndjson, read_ndjson
 
 # Setting up a logger with uvicorn output stream
 logger = logging.getLogger("uvicorn.error")
 logging.basicConfig(level=logging.INFO)
 
+# Metric of requests by type of recommendations served
+RECS_REQUESTS = REGISTRY.register(
+    Counter(
+        "recsys_recs_requests_total",
+        "Users served offline recommendations by type of recommendations.",
+        ("type",),
+    )
+)
+# Metrics of micro-batches of ranking model inference
+RANKING_CALLS = REGISTRY.register(
+    Counter(
+        "recsys_ranking_calls_total",
+        "Requests whose candidates were ranked by the model.",
+    )
+)
+RANKING_BATCHES = REGISTRY.register(
+    Counter(
+        "recsys_ranking_batches_total",
+        "Calls of the ranking model (each one for a micro-batch of requests).",
+    )
+)
+RANKING_ROWS = REGISTRY.register(
+    Counter(
+        "recsys_ranking_candidates_total",
+        "Candidates scored by the ranking model.",
+    )
+)
+
 
 class Recommender:
     """Class for generating offline recommendations."""
 
+    # Columns (and their types) used from the files of each type of recs
+    COLUMNS = {
+        "personal": {"user_id": "int32", "track_id": "int32", "als_score": "float32"},
+        "default": {"track_id": "int32"},
+    }
+    # Columns needed only for ranking (files without them are served unranked)
+    OPTIONAL_COLUMNS = ("als_score",)
+
     def __init__(self):
         """Initializes a class instance."""
         # Attribute for storing rec-data
@@ -27,56 +91,335 @@ class Recommender:
             "request_personal_count": 0,
             "request_default_count": 0,
         }
+        # Model ranking candidates at request time (if loaded)
+        self.ranker = None
+        # Attributes for storing versions of loaded data files and load time
+        self._versions = {}
+        self.loaded_at = None
+        self.load_duration = None
+        self.load_memory = {}
 
-    def load(self, rec_type, path, **kwargs):
+    def load(self, rec_type, path):
         """Loads offline recommendations."""
         logger.info(f"Loading recommendations: {rec_type}")
-        self._recs[rec_type] = pd.read_parquet(path, **kwargs)
+        columns = present_columns(path, self.COLUMNS[rec_type], self.OPTIONAL_COLUMNS)
+        recs, memory = read_columns(path, columns)
+        # Keeping ranked track lists in compact arrays instead of a DataFrame
         if rec_type == "personal":
-            self._recs[rec_type] = self._recs[rec_type].set_index("user_id")
+            user_ids = recs.pop("user_id")
+            self._recs[rec_type] = RankedIndex.from_arrays(user_ids, **recs)
+        else:
+            self._recs[rec_type] = recs["track_id"]
+        self._versions[path] = file_version(path)
+        self.load_memory[rec_type] = memory
+        logger.info(
+            "Recommendations loaded "
+            f"(peak memory {memory['peak_bytes'] / 1024**2:.1f} MB, "
+            f"steady memory {memory['steady_bytes'] / 1024**2:.1f} MB)"
+        )
+
+    def load_lazy(self, path: str):
+        """Opens personal recommendations partitioned for lazy loading."""
+        logger.info(f"Opening recommendations for lazy loading: {path}")
+        columns = present_columns(path, self.COLUMNS["personal"], self.OPTIONAL_COLUMNS)
+        columns.pop("user_id")
+        self._recs["personal"] = LazyRankedIndex(
+            path, "user_id", columns, LAZY_RECS_CACHE_SIZE
+        )
+        self._versions[path] = file_version(path)
+        self.load_memory["personal"] = {
+            "peak_bytes": 0,
+            "steady_bytes": self._recs["personal"].nbytes,
+        }
+        logger.info(f"{len(self._recs['personal'])} row groups indexed")
+
+    def load_snapshot(self, path: str):
+        """Maps offline recommendations from a compiled snapshot."""
+        logger.info(f"Loading recommendations snapshot: {path}")
+        arrays, _ = read_snapshot(path)
+        self._recs["personal"] = RankedIndex.from_snapshot(arrays, "personal")
+        self._recs["default"] = arrays["default.track_id"]
+        self._versions = {path: file_version(path)}
+        self.load_memory = {
+            "snapshot": {
+                "peak_bytes": 0,
+                "steady_bytes": self._recs["personal"].nbytes
+                + self._recs["default"].nbytes,
+            }
+        }
         logger.info("Recommendations loaded")
 
-    def get(self, user_id: int, k: int = 10):
-        """Generates k offline recommendations for user."""
-        if user_id in self._recs["personal"].index:
-            recs = self._recs["personal"].loc[user_id]
-            recs = recs["track_id"].tolist()[:k]
+    def load_ranker(
+        self, model_path: str, track_features_path: str, genre_features_path: str
+    ):
+        """Loads the ranking model and features of candidates."""
+        # ALS scores of candidates are taken from the loaded personal recs
+        if "als_score" not in self._recs["personal"].columns:
+            raise RankingUnavailableError("Personal recommendations lack ALS scores")
+        ranker = Ranker()
+        ranker.load(model_path, track_features_path, genre_features_path)
+        self.ranker = ranker
+        for path in (model_path, track_features_path, genre_features_path):
+            self._versions[path] = file_version(path)
+        self.load_memory["ranking"] = {"peak_bytes": 0, "steady_bytes": ranker.nbytes}
+
+    def save_snapshot(self, path: str):
+        """Saves loaded offline recommendations to a snapshot."""
+        arrays = self._recs["personal"].to_snapshot("personal")
+        arrays["default.track_id"] = self._recs["default"]
+        write_snapshot(path, arrays)
+
+    @property
+    def version(self):
+        """Returns the version of loaded recommendations."""
+        return "/".join(self._versions[path] for path in sorted(self._versions))
+
+    def sources_changed(self):
+        """Checks if files of loaded recommendations have changed on disk."""
+        return files_changed(self._versions)
+
+    def swap(self, other):
+        """Replaces loaded recommendations with those of another instance."""
+        (
+            self._recs,
+            self.ranker,
+            self._versions,
+            self.loaded_at,
+            self.load_duration,
+            self.load_memory,
+        ) = (
+            other._recs,
+            other.ranker,
+            other._versions,
+            other.loaded_at,
+            other.load_duration,
+            other.load_memory,
+        )
+
+    def lookup(self, user_ids: list, k: int):
+        """Looks up k personal recommendations of users (None if a user has none).
+
+        Only reads the data, so it may run in a thread (see read), leaving
+        request counts to be updated on the event loop.
+        """
+        return self._recs["personal"].get_many(user_ids, "track_id", k)
+
+    async def read(self, function, *args):
+        """Calls a function reading the data (in a thread in lazy mode).
+
+        Row groups decoded on demand would otherwise block the event loop.
+        """
+        if isinstance(self._recs["personal"], LazyRankedIndex):
+            return await asyncio.to_thread(function, *args)
+
+        return function(*args)
+
+    def get(self, user_id: int, k: int = 10, looked_up: list = None):
+        """Generates k offline recommendations for user.
+
+        Personal recommendations already looked up by lookup may be passed.
+        """
+        if looked_up is None:
+            looked_up = self.lookup([user_id], k)
+        recs = looked_up[0]
+        if recs is not None:
+            recs = recs.tolist()
             self._stats["request_personal_count"] += 1
-            logger.info(f"user {user_id} - using personal history")
+            if sampled("recs_personal"):
+                logger.info("user %s - using personal history", user_id)
         else:
-            recs = self._recs["default"]
-            recs = recs["track_id"].tolist()[:k]
+            recs = self._recs["default"][:k].tolist()
             self._stats["request_default_count"] += 1
-            logger.info(f"user {user_id} - using default")
+            if sampled("recs_default"):
+                logger.info("user %s - using default", user_id)
+
+        return recs
+
+    def get_batch(self, user_ids: list, k: int = 10, looked_up: list = None):
+        """Generates k offline recommendations for each user of a list.
+
+        Personal recommendations already looked up by lookup may be passed.
+        """
+        personal = self.lookup(user_ids, k) if looked_up is None else looked_up
+        default = self._recs["default"][:k].tolist()
+
+        # Falling back to default recommendations for users without history
+        recs = [
+            user_recs.tolist() if user_recs is not None else default
+            for user_recs in personal
+        ]
+        personal_count = sum(user_recs is not None for user_recs in personal)
+        self._stats["request_personal_count"] += personal_count
+        self._stats["request_default_count"] += len(user_ids) - personal_count
+        logger.info(f"{len(user_ids)} users - {personal_count} with personal history")
 
         return recs
 
+    def candidates(self, user_id: int, track_ids: list, k: int):
+        """Returns offline and given candidates of a user to be ranked."""
+        if self.ranker is None:
+            raise RankingUnavailableError("Ranking model is not loaded")
+        personal = self._recs["personal"]
+        offline = personal.get(user_id, "track_id", RANKING_OFFLINE_CANDIDATES)
+        if offline is not None:
+            offline_scores = personal.get(user_id, "als_score", len(offline))
+        else:
+            offline, offline_scores = self._recs["default"][:k], None
+
+        return self.ranker.candidates(offline, offline_scores, track_ids)
+
+    def predict(self, features: dict):
+        """Predicts scores of candidates by the ranking model."""
+        return self.ranker.predict(features)
+
+
+async def read_user_ids(request: Request):
+    """Reads user identifiers from a JSON list or a stream of NDJSON lines."""
+    try:
+        if not is_ndjson(request):
+            user_ids = await request.json()
+            if not isinstance(user_ids, list):
+                raise TypeError("Body is not a list")
+            return check_ids(user_ids)
+
+        # Parsing NDJSON lines (bare identifiers or objects) as they arrive
+        user_ids = []
+        async for objects in read_ndjson(request):
+            user_ids += check_ids(
+                [u["user_id"] if isinstance(u, dict) else u for u in objects]
+            )
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=400, detail="Body is not a list of integer user ids"
+        )
+
+    return user_ids
+
+
+def load_rec_store():
+    """Loads offline recommendations from a snapshot (if compiled) or parquet."""
+    start = time.time()
+    rec_store = Recommender()
+    if os.environ.get(RECS_STORE_MODE_ENV) == "lazy":
+        rec_store.load_lazy(path=LAZY_RECS_PATH)
+        rec_store.load(rec_type="default", path=DEFAULT_RECS_PATH)
+    elif os.path.exists(RECS_SNAPSHOT_PATH):
+        rec_store.load_snapshot(path=RECS_SNAPSHOT_PATH)
+    else:
+        rec_store.load(rec_type="personal", path=PERSONAL_RECS_PATH)
+        rec_store.load(rec_type="default", path=DEFAULT_RECS_PATH)
+    # Ranking candidates at request time if the model has been saved
+    if os.path.exists(RANKING_MODEL_PATH):
+        try:
+            rec_store.load_ranker(
+                RANKING_MODEL_PATH, TRACK_FEATURES_PATH, GENRE_FEATURES_PATH
+            )
+        except (RankingUnavailableError, OSError) as e:
+            # Serving unranked recommendations (e.g. if features are missing)
+            logger.warning(f"Recommendations are not ranked: {e}")
+    rec_store.loaded_at = time.time()
+    rec_store.load_duration = rec_store.loaded_at - start
+
+    return rec_store
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Loads data on application start-up."""
-    rec_store = Recommender()
-    rec_store.load(rec_type="personal", path=PERSONAL_RECS_PATH)
-    rec_store.load(rec_type="default", path=DEFAULT_RECS_PATH)
+    rec_store = load_rec_store()
+    rec_reloader = Reloader(rec_store, load_rec_store)
+    # Exposing loaded data and request counts of the store as metrics
+    observe_store("recs", rec_store)
+    RECS_REQUESTS.set_function(
+        lambda: rec_store._stats["request_personal_count"], "personal"
+    )
+    RECS_REQUESTS.set_function(
+        lambda: rec_store._stats["request_default_count"], "default"
+    )
+    # Grouping ranking model calls of concurrent requests into micro-batches
+    rec_batcher = MicroBatcher(
+        rec_store.predict, RANKING_BATCH_WINDOW, RANKING_MAX_BATCH_SIZE
+    )
+    RANKING_CALLS.set_function(lambda: rec_batcher._stats["calls"])
+    RANKING_BATCHES.set_function(lambda: rec_batcher._stats["batches"])
+    RANKING_ROWS.set_function(lambda: rec_batcher._stats["rows"])
+    if DATA_WATCH_INTERVAL:
+        task = asyncio.create_task(rec_reloader.watch(DATA_WATCH_INTERVAL))
+
+    # Writing logs in background while serving requests
+    with background_logging():
+        yield {
+            "rec_store": rec_store,
+            "rec_reloader": rec_reloader,
+            "rec_batcher": rec_batcher,
+        }
 
-    yield {"rec_store": rec_store}
+    if DATA_WATCH_INTERVAL:
+        task.cancel()
 
 
 # Creating an app
 app = FastAPI(title="recommendations_offline", lifespan=lifespan)
+instrument(app)
 
 
 # Endpoint for getting offline recommendations
 @app.post("/get_recs")
-async def recommendations(request: Request, user_id: int, k: int):
+async def recommendations(request: Request, user_id: int, k: int = Query(ge=0)):
     """Generates offline recommendations."""
     rec_store = request.state.rec_store
 
-    i2i = rec_store.get(user_id, k)
+    looked_up = await rec_store.read(rec_store.lookup, [user_id], k)
+    i2i = rec_store.get(user_id, k, looked_up)
 
     return i2i
 
 
+# Endpoint for getting offline recommendations of many users at once
+@app.post("/get_recs_batch")
+async def recommendations_batch(request: Request, k: int = Query(ge=0)):
+    """Streams offline recommendations for a list of users as NDJSON."""
+    rec_store = request.state.rec_store
+
+    def to_ndjson(user_ids, looked_up):
+        recs = rec_store.get_batch(user_ids, k, looked_up)
+        lines = [
+            json.dumps({"user_id": user_id, "recs": user_recs})
+            for user_id, user_recs in zip(user_ids, recs)
+        ]
+        return "\n".join(lines) + "\n"
+
+    # Generating chunks on the event loop (as other requests update the stats),
+    # only looking up recommendations in a thread in lazy mode
+    async def generate(user_ids):
+        for start in range(0, len(user_ids), BULK_RECS_CHUNK_SIZE):
+            chunk = user_ids[start : start + BULK_RECS_CHUNK_SIZE]
+            yield to_ndjson(chunk, await rec_store.read(rec_store.lookup, chunk, k))
+
+    user_ids = await read_user_ids(request)
+
+    return StreamingResponse(generate(user_ids), media_type="application/x-ndjson")
+
+
+# Endpoint for getting offline and online candidates ranked by the model
+@app.post("/get_recs_ranked")
+async def recommendations_ranked(
+    request: Request,
+    user_id: int,
+    k: int = Query(ge=0),
+    track_ids: list[int] = Body(default=[], embed=True),
+):
+    """Ranks offline recommendations of a user along with given candidates."""
+    rec_store = request.state.rec_store
+    rec_batcher = request.state.rec_batcher
+    try:
+        candidates = await rec_store.read(rec_store.candidates, user_id, track_ids, k)
+    except RankingUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return await rank(rec_store.ranker, rec_batcher, candidates, k)
+
+
 @app.get("/healthy")
 async def healthy():
     """Displays status message."""
@@ -89,3 +432,30 @@ async def get_stats(request: Request):
     rec_store = request.state.rec_store
 
     return rec_store._stats
+
+
+@app.get("/version")
+async def version(request: Request):
+    """Displays the version and load time of loaded recommendations."""
+    rec_store = request.state.rec_store
+
+    return {
+        "version": rec_store.version,
+        "loaded_at": rec_store.loaded_at,
+        "load_duration": rec_store.load_duration,
+        "load_memory": rec_store.load_memory,
+    }
+
+
+@app.post("/reload")
+async def reload(request: Request):
+    """Reloads recommendations in background (old ones are served meanwhile)."""
+    rec_reloader = request.state.rec_reloader
+    try:
+        await rec_reloader.reload()
+    except ReloadInProgressError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Reload failed: {e}")
+
+    return await version(request)
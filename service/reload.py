@@ -0,0 +1,67 @@
+"""Hot reload of the stores' data without restarting a service.
+
+New data is loaded into a separate store instance in a worker thread while
+the old one keeps serving requests, and is then swapped in at once. If loading
+fails, the old data stays in use.
+"""
+import asyncio
+import logging
+import os
+
+# Setting up a logger with uvicorn output stream
+logger = logging.getLogger("uvicorn.error")
+
+
+def file_version(path: str):
+    """Returns a version of a data file derived from its size and modification time."""
+    stat = os.stat(path)
+
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+def files_changed(versions: dict):
+    """Checks if any of the data files differs from its loaded version."""
+    for path, version in versions.items():
+        # Skipping files which are missing (e.g. while being replaced)
+        if os.path.exists(path) and file_version(path) != version:
+            return True
+
+    return False
+
+
+class ReloadInProgressError(Exception):
+    """Raised when a reload is requested while another one is running."""
+
+
+class Reloader:
+    """Class for reloading data of a store in background."""
+
+    def __init__(self, store, load):
+        """Initializes a class instance."""
+        self.store = store
+        self.load = load
+        self.lock = asyncio.Lock()
+
+    async def reload(self):
+        """Loads new data in a worker thread and swaps it into the store."""
+        if self.lock.locked():
+            raise ReloadInProgressError("Reload is already in progress")
+        async with self.lock:
+            try:
+                new_store = await asyncio.to_thread(self.load)
+            except Exception:
+                logger.exception("Reload failed, keeping the current data")
+                raise
+            self.store.swap(new_store)
+            logger.info(f"Reloaded data, version {self.store.version}")
+
+    async def watch(self, interval: float):
+        """Reloads data each time its files change on disk."""
+        while True:
+            await asyncio.sleep(interval)
+            if self.store.sources_changed() and not self.lock.locked():
+                try:
+                    await self.reload()
+                except Exception:
+                    # Retrying at the next check (the failure is logged)
+                    pass
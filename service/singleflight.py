@@ -0,0 +1,108 @@
+"""Coalescing of identical concurrent calls to the stores (single-flight).
+
+While a call to a store is in flight, identical calls (same method and
+arguments) do not reach the store but wait for the result of the first one,
+which is then shared by all of them (so it must not be modified in place).
+Calls for lists of keys (e.g. track ids) can be coalesced by key instead, so
+that only keys which are not already in flight are requested.
+"""
+import asyncio
+import functools
+
+from .metrics import REGISTRY, Counter
+
+# Metric of calls served by identical calls already in flight
+COALESCED_CALLS = REGISTRY.register(
+    Counter(
+        "recsys_store_calls_coalesced_total",
+        "Calls of the main application to the stores merged into identical "
+        "calls already in flight.",
+        ("store", "call"),
+    )
+)
+
+
+def freeze(value):
+    """Turns lists (e.g. of track ids) into tuples to use arguments as a key."""
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+
+    return value
+
+
+def coalesced(store: str, call: str):
+    """Decorates an async call to a store to merge identical concurrent calls."""
+
+    def decorator(method):
+        # Calls in flight (by instance and arguments)
+        flights = {}
+
+        def forget(key, task):
+            flights.pop(key, None)
+            # Retrieving the exception in case all waiters have been cancelled
+            if not task.cancelled():
+                task.exception()
+
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            key = (id(self), freeze(args), freeze(sorted(kwargs.items())))
+            task = flights.get(key)
+            if task is None:
+                task = asyncio.ensure_future(method(self, *args, **kwargs))
+                flights[key] = task
+                task.add_done_callback(functools.partial(forget, key))
+            else:
+                COALESCED_CALLS.inc(store, call)
+            # Cancelling a waiter does not cancel the call shared with others
+            return await asyncio.shield(task)
+
+        return wrapper
+
+    return decorator
+
+
+def coalesced_by_key(store: str, call: str):
+    """Decorates an async call for a list of keys to merge concurrent calls by key.
+
+    The decorated method takes a list of keys first and returns a list of
+    results in their order. Results of keys in flight are waited for, and the
+    other keys are requested in one call.
+    """
+
+    def decorator(method):
+        # Results in flight (by instance, key and other arguments)
+        flights = {}
+
+        def resolve(call_key, futures, task):
+            for i, (key, future) in enumerate(futures.items()):
+                flights.pop((key, call_key), None)
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result()[i])
+
+        @functools.wraps(method)
+        async def wrapper(self, keys: list, *args, **kwargs):
+            call_key = (id(self), freeze(args), freeze(sorted(kwargs.items())))
+            missing = [
+                key for key in dict.fromkeys(keys) if (key, call_key) not in flights
+            ]
+            coalesced_keys = len(set(keys)) - len(missing)
+            if coalesced_keys:
+                COALESCED_CALLS.inc(store, call, amount=coalesced_keys)
+            if missing:
+                loop = asyncio.get_running_loop()
+                futures = {key: loop.create_future() for key in missing}
+                for key, future in futures.items():
+                    flights[(key, call_key)] = future
+                task = asyncio.ensure_future(method(self, missing, *args, **kwargs))
+                task.add_done_callback(functools.partial(resolve, call_key, futures))
+            results = asyncio.gather(*(flights[(key, call_key)] for key in keys))
+            # Cancelling a waiter does not cancel the results shared with others
+            return list(await asyncio.shield(results))
+
+        return wrapper
+
+    return decorator
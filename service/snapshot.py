@@ -0,0 +1,80 @@
+"""Binary snapshot format of flat arrays shared by the stores through mmap.
+
+Layout of a snapshot file:
+
+    - magic bytes `RECSNAP\\0` and format version (uint32)
+    - length of a JSON header (uint64) followed by the header itself
+    - arrays aligned to 64 bytes, their dtypes, shapes and offsets being
+      listed in the header
+"""
+import json
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+SNAPSHOT_MAGIC = b"RECSNAP\0"
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 64
+PREFIX = struct.Struct("<8sIQ")
+
+
+def align(offset: int):
+    """Rounds an offset up to the alignment of arrays."""
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(path: str, arrays: dict, meta: dict = None):
+    """Writes arrays with metadata to a snapshot file (atomically)."""
+    # Computing offsets of arrays relative to the start of data
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        specs[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = align(offset + array.nbytes)
+    meta = dict(meta or {}, created_at=time.time())
+    header = json.dumps({"meta": meta, "arrays": specs}).encode()
+    data_start = align(PREFIX.size + len(header))
+
+    # Writing to a temporary file first so that readers never see a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fd:
+        fd.write(PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+        fd.write(header)
+        for name, array in arrays.items():
+            fd.seek(data_start + specs[name]["offset"])
+            np.ascontiguousarray(array).tofile(fd)
+        fd.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str):
+    """Maps a snapshot file read-only and returns its arrays and metadata."""
+    with open(path, "rb") as fd:
+        buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, header_size = PREFIX.unpack_from(buffer)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"File '{path}' is not a snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot version {version} is not supported")
+    header = json.loads(buffer[PREFIX.size : PREFIX.size + header_size])
+    data_start = align(PREFIX.size + header_size)
+
+    # Creating zero-copy views of arrays over the mapped file
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        arrays[name] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + spec["offset"]
+        ).reshape(spec["shape"])
+
+    return arrays, header["meta"]
@@ -0,0 +1,219 @@
+"""Interface of the main application to the recs, features and events stores.
+
+Stores are either accessed over HTTP (each one running as a separate service)
+or loaded into the process of the main application ("all" mode), both ways
+exposing the same async methods.
+"""
+import logging
+
+import httpx
+import numpy as np
+
+from .constants import (
+    BASE_URL,
+    RECS_OFFLINE_SERVICE_PORT,
+    EVENTS_SERVICE_PORT,
+    FEATURES_SERVICE_PORT,
+    RECS_STORE_POOL_SIZE,
+    EVENTS_STORE_POOL_SIZE,
+    FEATURES_STORE_POOL_SIZE,
+    RECS_STORE_TIMEOUT,
+    EVENTS_STORE_TIMEOUT,
+    FEATURES_STORE_TIMEOUT,
+)
+from .merge import merge_neighbours
+from .metrics import timed
+from .ranking import RankingUnavailableError, rank
+from .singleflight import coalesced, coalesced_by_key
+
+headers = {"Content-type": "application/json", "Accept": "text/plain"}
+recommendations_url = BASE_URL + ":" + str(RECS_OFFLINE_SERVICE_PORT)
+events_url = BASE_URL + ":" + str(EVENTS_SERVICE_PORT)
+features_url = BASE_URL + ":" + str(FEATURES_SERVICE_PORT)
+
+# Not logging each call to the stores (they are timed in metrics instead)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def create_client(base_url: str, pool_size: int, timeout: float):
+    """Creates an async client keeping a pool of connections to a store."""
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+    )
+
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers=headers,
+        limits=limits,
+        timeout=timeout,
+    )
+
+
+class HttpStores:
+    """Class for calling the stores running as separate services.
+
+    Identical concurrent calls to the recs store are merged into one, and so
+    are requests of similar tracks of the same track by concurrent calls to the
+    features store (online history is not, since it changes with each event).
+    """
+
+    def __init__(self):
+        """Initializes a class instance."""
+        self.clients = {
+            "recs": create_client(
+                recommendations_url, RECS_STORE_POOL_SIZE, RECS_STORE_TIMEOUT
+            ),
+            "events": create_client(
+                events_url, EVENTS_STORE_POOL_SIZE, EVENTS_STORE_TIMEOUT
+            ),
+            "features": create_client(
+                features_url, FEATURES_STORE_POOL_SIZE, FEATURES_STORE_TIMEOUT
+            ),
+        }
+
+    @coalesced("recs", "get_recs")
+    @timed("recs", "get_recs")
+    async def get_recs(self, user_id: int, k: int):
+        """Retrieves k offline recommendations for a user."""
+        params = {"user_id": user_id, "k": k}
+        response = await self.clients["recs"].post("/get_recs", params=params)
+
+        return response.json()
+
+    @coalesced("recs", "get_recs_ranked")
+    @timed("recs", "get_recs_ranked")
+    async def get_recs_ranked(self, user_id: int, k: int, track_ids: list):
+        """Retrieves k recommendations for a user ranked along with candidates.
+
+        Returns None if the recs store does not rank recommendations.
+        """
+        params = {"user_id": user_id, "k": k}
+        response = await self.clients["recs"].post(
+            "/get_recs_ranked", params=params, json={"track_ids": track_ids}
+        )
+        if response.status_code == 503:
+            return None
+
+        return response.json()
+
+    @timed("events", "get_events")
+    async def get_events(self, user_id: int, k: int):
+        """Retrieves k latest online events of a user."""
+        params = {"user_id": user_id, "k": k}
+        response = await self.clients["events"].post("/get", params=params)
+
+        return response.json()["events"]
+
+    async def similar_tracks(self, track_ids: list, k: int, how: str):
+        """Retrieves k merged tracks similar to a list of tracks.
+
+        Similar tracks of each track are requested once for concurrent calls
+        (e.g. of users who recently listened to the same popular track) and
+        merged locally.
+        """
+        results = await self.track_neighbours(track_ids, k)
+        lengths = [len(result["track_id_2"]) for result in results]
+
+        return merge_neighbours(
+            np.array([t for result in results for t in result["track_id_2"]]),
+            np.array([s for result in results for s in result["score"]]),
+            np.repeat(np.arange(len(results)), lengths),
+            k,
+            how,
+        )
+
+    @coalesced_by_key("features", "similar_tracks")
+    @timed("features", "similar_tracks")
+    async def track_neighbours(self, track_ids: list, k: int):
+        """Retrieves k tracks similar to each of a list of tracks."""
+        response = await self.clients["features"].post(
+            "/similar_tracks_batch", params={"k": k}, json=track_ids
+        )
+
+        return response.json()["results"]
+
+    async def get_stats(self):
+        """Retrieves statistics of the recs store."""
+        response = await self.clients["recs"].get("/get_stats")
+
+        return response.json()
+
+    async def get_version(self):
+        """Retrieves the data version of the recs store."""
+        response = await self.clients["recs"].get("/version")
+
+        return response.json()["version"]
+
+    async def healthy(self):
+        """Verifies connection to all stores."""
+        try:
+            for client in self.clients.values():
+                await client.get("/healthy")
+        except httpx.TransportError:
+            return False
+
+        return True
+
+    async def close(self):
+        """Closes all connections."""
+        for client in self.clients.values():
+            await client.aclose()
+
+
+class LocalStores:
+    """Class for calling the stores loaded into the current process."""
+
+    def __init__(self, rec_store, rec_batcher, sim_items_store, event_store):
+        """Initializes a class instance."""
+        self.rec_store = rec_store
+        self.rec_batcher = rec_batcher
+        self.sim_items_store = sim_items_store
+        self.event_store = event_store
+
+    @timed("recs", "get_recs")
+    async def get_recs(self, user_id: int, k: int):
+        """Retrieves k offline recommendations for a user."""
+        looked_up = await self.rec_store.read(self.rec_store.lookup, [user_id], k)
+
+        return self.rec_store.get(user_id, k, looked_up)
+
+    @timed("recs", "get_recs_ranked")
+    async def get_recs_ranked(self, user_id: int, k: int, track_ids: list):
+        """Retrieves k recommendations for a user ranked along with candidates.
+
+        Returns None if the recs store does not rank recommendations.
+        """
+        try:
+            candidates = await self.rec_store.read(
+                self.rec_store.candidates, user_id, track_ids, k
+            )
+        except RankingUnavailableError:
+            return None
+
+        return await rank(self.rec_store.ranker, self.rec_batcher, candidates, k)
+
+    @timed("events", "get_events")
+    async def get_events(self, user_id: int, k: int):
+        """Retrieves k latest online events of a user."""
+        return self.event_store.get(user_id, k)
+
+    @timed("features", "similar_tracks")
+    async def similar_tracks(self, track_ids: list, k: int, how: str):
+        """Retrieves k merged tracks similar to a list of tracks."""
+        return self.sim_items_store.get_batch(track_ids, k, merge=True, how=how)
+
+    async def get_stats(self):
+        """Retrieves statistics of the recs store."""
+        return dict(self.rec_store._stats)
+
+    async def get_version(self):
+        """Retrieves the data version of the recs store."""
+        return self.rec_store.version
+
+    async def healthy(self):
+        """Verifies that all stores are loaded."""
+        return True
+
+    async def close(self):
+        """Releases nothing (stores live as long as the process)."""
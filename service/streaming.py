@@ -0,0 +1,35 @@
+"""Helpers for reading streamed request bodies."""
+import json
+
+import numpy as np
+from fastapi import Request
+
+# Largest identifier of users and tracks (they are stored as int64)
+MAX_ID = int(np.iinfo(np.int64).max)
+
+
+async def read_ndjson(request: Request):
+    """Yields lists of objects parsed from NDJSON lines as chunks arrive."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        objects = [json.loads(line) for line in lines if line.strip()]
+        if objects:
+            yield objects
+    if buffer.strip():
+        yield [json.loads(buffer)]
+
+
+def is_ndjson(request: Request):
+    """Checks if a request body is sent as NDJSON."""
+    return request.headers.get("content-type", "").startswith("application/x-ndjson")
+
+
+def check_ids(ids: list):
+    """Raises ValueError unless identifiers are integers from 0 to MAX_ID."""
+    for value in ids:
+        if type(value) is not int or not 0 <= value <= MAX_ID:
+            raise ValueError(f"Invalid identifier: {value!r}")
+
+    return ids
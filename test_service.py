@@ -1,6 +1,12 @@
 """Tests the recommendations service."""
+import asyncio
+import json
 import logging
+import os
+import tempfile
 import unittest
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
@@ -8,12 +14,19 @@ from service.constants import (
     BASE_URL,
     MAIN_APP_PORT,
     EVENTS_SERVICE_PORT,
+    FEATURES_SERVICE_PORT,
+    RECS_OFFLINE_SERVICE_PORT,
 )
+from service.cache import RecsCache
+from service.events_service import DurableEventStore
+from service.recommendations_service import recommendations_offline
 
 # Request components
 headers = {"Content-type": "application/json", "Accept": "text/plain"}
 main_app_url = BASE_URL + ":" + str(MAIN_APP_PORT)
 events_url = BASE_URL + ":" + str(EVENTS_SERVICE_PORT)
+features_url = BASE_URL + ":" + str(FEATURES_SERVICE_PORT)
+recs_url = BASE_URL + ":" + str(RECS_OFFLINE_SERVICE_PORT)
 
 # Configuring the logger
 logger = logging.getLogger("unittest_logger")
@@ -201,6 +214,329 @@ class TestRecommendationsService(unittest.TestCase):
         self.assertGreater(response_personal_stats, 0)
         logger.info("Test 9 PASS")
 
+    def test_10_similar_tracks_batch(self, track_ids: list = [3911, 1168, 8449]):
+        """Tests if batch similar tracks match single-track requests."""
+        logger.info("-" * 69)
+        logger.info('Test 10: "Batch similar tracks check"')
+        resp = requests.post(
+            features_url + "/similar_tracks_batch",
+            params={"k": 5},
+            json=track_ids,
+        )
+        get_server_info(response=resp)
+        results = resp.json()["results"]
+        for track_id, result in zip(track_ids, results):
+            response = send_test_request(
+                params={"track_id": track_id, "k": 5},
+                url=features_url,
+                endpoint="/similar_tracks",
+            )
+            self.assertEqual(result["track_id_2"], response["track_id_2"])
+
+        self.assertEqual(len(results), len(track_ids))
+        logger.info("Test 10 PASS")
+
+    def test_11_bulk_offline_recommendations(self, user_ids: list = [5, 28073]):
+        """Tests if bulk offline recs match single-user requests."""
+        logger.info("-" * 69)
+        logger.info('Test 11: "Bulk offline recs check"')
+        resp = requests.post(
+            recs_url + "/get_recs_batch",
+            params={"k": 5},
+            data="\n".join(str(user_id) for user_id in user_ids),
+            headers={"Content-type": "application/x-ndjson"},
+        )
+        get_server_info(response=resp)
+        results = [json.loads(line) for line in resp.text.splitlines()]
+        for user_id, result in zip(user_ids, results):
+            response = send_test_request(
+                params={"user_id": user_id, "k": 5},
+                url=recs_url,
+                endpoint="/get_recs",
+            )
+            self.assertEqual(result["user_id"], user_id)
+            self.assertEqual(result["recs"], response)
+
+        self.assertEqual(len(results), len(user_ids))
+        for body in ({"user_id": 5}, [5, 2**64], [1.7]):
+            resp = requests.post(
+                recs_url + "/get_recs_batch", params={"k": 5}, json=body
+            )
+            get_server_info(response=resp)
+
+            self.assertEqual(resp.status_code, 400)
+        logger.info("Test 11 PASS")
+
+    def test_12_events_stats(self, user_id: int = 77, track_id: int = 3911):
+        """Tests if the events store reports resident users."""
+        logger.info("-" * 69)
+        logger.info('Test 12: "Events store stats check"')
+        send_test_request(
+            params={"user_id": user_id, "track_id": track_id},
+            url=events_url,
+            endpoint="/put",
+        )
+        response = requests.get(events_url + "/get_stats")
+        get_server_info(response=response)
+        response = response.json()
+
+        self.assertGreater(response["resident_users"], 0)
+        logger.info("Test 12 PASS")
+
+    def test_13_bulk_events(self, user_id: int = 91, events: list = [3911, 1168]):
+        """Tests if events added in bulk or as a stream keep their order."""
+        logger.info("-" * 69)
+        logger.info('Test 13: "Bulk events check"')
+        resp = requests.post(
+            events_url + "/put_batch",
+            json={"user_ids": [user_id] * len(events), "track_ids": events},
+        )
+        get_server_info(response=resp)
+        self.assertEqual(resp.json()["accepted"], len(events))
+        resp = requests.post(
+            events_url + "/put_stream",
+            data="\n".join(
+                json.dumps({"user_id": user_id, "track_id": track_id})
+                for track_id in events
+            ),
+            headers={"Content-type": "application/x-ndjson"},
+        )
+        get_server_info(response=resp)
+        self.assertEqual(resp.json()["accepted"], len(events))
+        online_history = send_test_request(
+            params={"user_id": user_id, "k": 2 * len(events)},
+            url=events_url,
+            endpoint="/get",
+        )
+
+        self.assertEqual(online_history["events"], 2 * events[::-1])
+        logger.info("Test 13 PASS")
+
+    def test_14_metrics(self, user_id: int = 28073):
+        """Tests if all services expose request latencies on /metrics."""
+        logger.info("-" * 69)
+        logger.info('Test 14: "Metrics check"')
+        send_test_request(
+            params={"user_id": user_id, "k": 5},
+            url=main_app_url,
+            endpoint="/recommendations",
+        )
+        for url in (recs_url, features_url, events_url, main_app_url):
+            response = requests.get(url + "/metrics")
+            get_server_info(response=response)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("recsys_request_duration_seconds_bucket", response.text)
+        # Checking timings of calls of the main application to the stores
+        self.assertIn('store="events",call="get_events"', response.text)
+        logger.info("Test 14 PASS")
+
+    def test_15_merged_similar_tracks(self, track_ids: list = [3911, 1168, 8449]):
+        """Tests if merged similar tracks are unique and ordered by score."""
+        logger.info("-" * 69)
+        logger.info('Test 15: "Merged similar tracks check"')
+        for how in ("max", "sum", "recency"):
+            resp = requests.post(
+                features_url + "/similar_tracks_batch",
+                params={"k": 10, "merge": True, "how": how},
+                json=track_ids,
+            )
+            get_server_info(response=resp)
+            response = resp.json()
+
+            self.assertEqual(len(set(response["track_id_2"])), len(response["score"]))
+            self.assertEqual(response["score"], sorted(response["score"], reverse=True))
+        resp = requests.post(
+            features_url + "/similar_tracks_batch",
+            params={"k": 10, "merge": True, "how": "median"},
+            json=track_ids,
+        )
+        get_server_info(response=resp)
+
+        self.assertEqual(resp.status_code, 400)
+        logger.info("Test 15 PASS")
+
+    def test_16_coalesced_requests(
+        self, user_ids: list = list(range(900000, 900020)), track_id: int = 3911
+    ):
+        """Tests if concurrent identical calls to the stores return the same result."""
+        logger.info("-" * 69)
+        logger.info('Test 16: "Coalesced requests check"')
+        # Users with the same recent track request its similar tracks once
+        for user_id in user_ids:
+            send_test_request(
+                params={"user_id": user_id, "track_id": track_id},
+                url=events_url,
+                endpoint="/put",
+            )
+        with ThreadPoolExecutor(max_workers=len(user_ids)) as executor:
+            responses = list(
+                executor.map(
+                    lambda user_id: send_test_request(
+                        params={"user_id": user_id, "k": 5},
+                        url=main_app_url,
+                        endpoint="/recommendations_online",
+                    ),
+                    user_ids,
+                )
+            )
+        response = requests.get(main_app_url + "/metrics")
+        get_server_info(response=response)
+
+        self.assertNotEqual(responses[0]["recs"], [])
+        self.assertTrue(all(resp == responses[0] for resp in responses))
+        sample = (
+            'recsys_store_calls_coalesced_total{store="features",call="similar_tracks"}'
+        )
+        coalesced = [
+            float(line.split()[-1])
+            for line in response.text.splitlines()
+            if line.startswith(sample)
+        ]
+        self.assertEqual(len(coalesced), 1)
+        self.assertGreater(coalesced[0], 0)
+        logger.info("Test 16 PASS")
+
+    def test_17_negative_k(self, user_id: int = 28073):
+        """Tests if a negative number of recommendations is rejected."""
+        logger.info("-" * 69)
+        logger.info('Test 17: "Negative k check"')
+        for endpoint in ("/get_recs", "/get_recs_batch"):
+            resp = requests.post(
+                recs_url + endpoint,
+                params={"user_id": user_id, "k": -1},
+                json=[user_id],
+            )
+            get_server_info(response=resp)
+
+            self.assertEqual(resp.status_code, 422)
+        for endpoint in ("/similar_tracks", "/similar_tracks_batch"):
+            resp = requests.post(
+                features_url + endpoint,
+                params={"track_id": 3911, "k": -1, "merge": True},
+                json=[3911],
+            )
+            get_server_info(response=resp)
+
+            self.assertEqual(resp.status_code, 422)
+        for params in ({"k": -1}, {"num_events": -1}):
+            resp = requests.post(
+                main_app_url + "/recommendations_online",
+                params={"user_id": user_id, **params},
+            )
+            get_server_info(response=resp)
+
+            self.assertEqual(resp.status_code, 422)
+        resp = requests.post(events_url + "/get", params={"user_id": user_id, "k": -1})
+        get_server_info(response=resp)
+
+        self.assertEqual(resp.status_code, 422)
+        resp = requests.post(
+            main_app_url + "/recommendations", params={"user_id": user_id, "k": -1}
+        )
+        get_server_info(response=resp)
+
+        self.assertEqual(resp.status_code, 422)
+        logger.info("Test 17 PASS")
+
+    def test_18_events_durability(self, user_id: int = 5, events: list = [3911, 1168]):
+        """Tests if online history is restored from the log and the snapshot."""
+        logger.info("-" * 69)
+        logger.info('Test 18: "Events durability check"')
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = (os.path.join(tmp, "events.log"), os.path.join(tmp, "events.snap"))
+            store = DurableEventStore(*paths)
+            store.restore()
+            store.put(user_id, events[0])
+            # Compacting the first event into the snapshot, the second one is logged
+            store.compact(store.log.rotate())
+            store.put(user_id, events[1])
+            store.log.close()
+
+            restarted = DurableEventStore(*paths)
+            restarted.restore()
+            restarted.log.close()
+
+        self.assertEqual(restarted.get(user_id, 5), events[::-1])
+        logger.info("Test 18 PASS")
+
+    def test_19_invalid_event_ids(self, user_id: int = 92, track_id: int = 3911):
+        """Tests if identifiers of events which do not fit into int64 are rejected."""
+        logger.info("-" * 69)
+        logger.info('Test 19: "Invalid event ids check"')
+        resp = requests.post(
+            events_url + "/put", params={"user_id": 2**64, "track_id": track_id}
+        )
+        get_server_info(response=resp)
+
+        self.assertEqual(resp.status_code, 422)
+        resp = requests.post(
+            events_url + "/put_batch",
+            json={"user_ids": [user_id, 2**64], "track_ids": [track_id, track_id]},
+        )
+        get_server_info(response=resp)
+
+        self.assertEqual(resp.status_code, 400)
+        resp = requests.post(
+            events_url + "/put_stream",
+            data=json.dumps({"user_id": user_id, "track_id": 1.5}),
+            headers={"Content-type": "application/x-ndjson"},
+        )
+        get_server_info(response=resp)
+
+        self.assertEqual(resp.status_code, 400)
+        events = send_test_request(
+            params={"user_id": user_id, "k": 5}, url=events_url, endpoint="/get"
+        )
+        self.assertEqual(events["events"], [])
+        logger.info("Test 19 PASS")
+
+    def test_20_recs_cache(self, user_id: int = 5, recs: list = [3911, 1168, 8449]):
+        """Tests hits, slicing by k and invalidation of cached recommendations."""
+        logger.info("-" * 69)
+        logger.info('Test 20: "Recommendations cache check"')
+        cache = RecsCache(max_users=1, ttl=60)
+        cache.set_version("v1")
+        self.assertIsNone(cache.get(user_id, 3))
+        cache.put(user_id, 3, recs)
+
+        # Requests with smaller k are served by slicing the cached list
+        self.assertEqual(cache.get(user_id, 3), recs)
+        self.assertEqual(cache.get(user_id, 2), recs[:2])
+        self.assertIsNone(cache.get(user_id, 5))
+        # A list shorter than requested holds all recommendations of a user
+        cache.put(user_id, 5, recs)
+        self.assertEqual(cache.get(user_id, 10), recs)
+
+        # The least recently used user is evicted
+        cache.put(user_id + 1, 3, recs)
+        self.assertIsNone(cache.get(user_id, 3))
+        # Entries are dropped when the data version changes
+        cache.set_version("v1")
+        self.assertEqual(cache.get(user_id + 1, 3), recs)
+        cache.set_version("v2")
+        self.assertIsNone(cache.get(user_id + 1, 3))
+
+        self.assertEqual(
+            {k: cache.stats[k] for k in ("hits", "evictions", "invalidations")},
+            {"hits": 4, "evictions": 1, "invalidations": 1},
+        )
+
+        # Recommendations fetched while the data version changes are not cached
+        async def get_recs(user_id, k):
+            cache.set_version("v3")
+            return recs[:k]
+
+        request = SimpleNamespace(
+            state=SimpleNamespace(
+                stores=SimpleNamespace(get_recs=get_recs), recs_cache=cache
+            )
+        )
+        response = asyncio.run(recommendations_offline(request, user_id, k=3))
+        self.assertEqual(response["recs"], recs)
+        self.assertIsNone(cache.get(user_id, 3))
+        logger.info("Test 20 PASS")
+
 
 if __name__ == "__main__":
     unittest.main()